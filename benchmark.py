@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+"""Benchmark the montage build, stage by stage, on seeded synthetic image libraries."""
+
+import argparse
+import contextlib
+import json
+import math
+import os
+import platform
+import shutil
+import sys
+import time
+
+import numpy as np
+import yaml
+
+from lib.build import BUILD_KEYS, find_locations, goal_layout, write_montage
+from lib.ingest import ingest, scan_sources
+from lib.matcher import ColorMatcher
+from lib.montage import calculate_big_pixels
+from lib.store import PaletteStore
+from lib.synthetic import FORMATS, make_goal, make_library
+from lib.synthetic import SIZES as IMAGE_SIZES
+
+SIZES = [1000, 4000, 16000, 64000, 256000]
+TILES = 20000
+COLOR_DISTANCE = 25
+
+# Config keys that change what the suite measures, recorded with its results
+SETTINGS = BUILD_KEYS + (
+    "workers",
+    "thumbnail_type",
+    "signature_grid",
+    "dedupe_distance",
+    "atlas",
+    "render_workers",
+)
+
+
+def linear_scan(colors, targets, color_distance, rng):
+    """Reference matcher: measure every palette color for every target."""
+    chosen = np.empty(len(targets), dtype=np.intp)
+    for i, target in enumerate(targets):
+        dist = np.linalg.norm(colors - target, axis=1)
+        chosen[i] = rng.choice(np.flatnonzero(dist <= dist.min() + color_distance))
+    return chosen
+
+
+def timed(func, *args):
+    """Run func and return the wall time it took."""
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def matcher_benchmark(seed):
+    """Nearest-color matching against growing palette sizes."""
+    rng = np.random.default_rng(seed)
+    targets = rng.integers(0, 256, size=(TILES, 3)).astype(np.float64)
+
+    print(f"Matching {TILES} tiles, color distance {COLOR_DISTANCE}, seed {seed}")
+    print("|  Palette |  Index  |  Match  |  Linear (per 1k tiles) |")
+    print("|----------|---------|---------|------------------------|")
+
+    totals = []
+    for size in SIZES:
+        colors = rng.integers(0, 256, size=(size, 3)).astype(np.float64)
+
+        start = time.perf_counter()
+        matcher = ColorMatcher(colors)
+        build = time.perf_counter() - start
+        match = timed(matcher.match, targets, COLOR_DISTANCE, rng)
+        linear = timed(linear_scan, colors, targets[:1000], COLOR_DISTANCE, rng)
+
+        totals.append(build + match)
+        print(f"| {size:8} | {build:6.3f}s | {match:6.3f}s | {linear:21.3f}s |")
+
+    slope = np.polyfit(np.log(SIZES), np.log(totals), 1)[0]
+    print(f"\nIndexed time grows as palette^{slope:.2f} (1.00 would be linear)")
+
+
+@contextlib.contextmanager
+def quiet():
+    """Keep the stages' own progress output off the terminal while they are timed."""
+    with open(os.devnull, "w", encoding="utf-8") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            yield
+
+
+def ingest_timings(config, library):
+    """Time a cold crawl, thumbnail and palette pass over a library.
+
+    Thumbnailing and palette rows are fused, so "thumbnail" runs until the
+    last thumbnail lands and "palette" is the dedupe and write-out after it.
+    """
+    for stale in (config["thumbdir"], config["palette"]):
+        if os.path.isdir(stale):
+            shutil.rmtree(stale)
+        elif os.path.exists(stale):
+            os.remove(stale)
+    os.makedirs(config["thumbdir"])
+
+    landed = []
+
+    def progress(stage, done, total=0):  # pylint: disable=unused-argument
+        if stage == "thumb":
+            landed.append(time.perf_counter())
+
+    with quiet():
+        start = time.perf_counter()
+        sources = scan_sources(library)
+        crawled = time.perf_counter()
+        ingest(config, sources, 1.0, progress)
+        end = time.perf_counter()
+
+    thumbed = landed[-1] if landed else crawled
+    return {"crawl": crawled - start, "thumbnail": thumbed - crawled, "palette": end - thumbed}
+
+
+def build_timings(config, goal, output):
+    """Time analyzing the goal, matching its tiles and rendering the montage."""
+    cache = PaletteStore(config["palette"])
+    with quiet():
+        start = time.perf_counter()
+        img = goal_layout(config, goal)
+        with img["ref"]:
+            bigpixels = calculate_big_pixels(
+                img, config["upscale"], config.get("signature_grid", 0)
+            )
+            analyzed = time.perf_counter()
+            locations = find_locations(config, cache, bigpixels)
+            matched = time.perf_counter()
+            write_montage(config, cache, img, bigpixels, locations, output)
+            end = time.perf_counter()
+
+    timings = {"analyze": analyzed - start, "match": matched - analyzed, "render": end - matched}
+    return timings, len(bigpixels)
+
+
+def record(results, stage, library, tiles, seconds):
+    """Add one timing to the results, keeping every sample of repeated runs."""
+    for result in results:
+        if (result["stage"], result["library"], result["tiles"]) == (stage, library, tiles):
+            result["samples"].append(seconds)
+            result["best"] = min(result["samples"])
+            return
+    results.append(
+        {"stage": stage, "library": library, "tiles": tiles, "best": seconds, "samples": [seconds]}
+    )
+
+
+def suite(config, args):  # pylint: disable=too-many-locals
+    """Time every stage over the grid of library sizes and tile counts."""
+    work = os.path.abspath(args.workdir)
+    run = os.path.join(work, "run")
+    config.update(
+        thumbdir=os.path.join(run, "thumbs"),
+        palette=os.path.join(run, "palette.db"),
+        dedupe_report=os.path.join(run, "duplicates.txt"),
+        thumb_hash=False,
+        frame_step=0,
+    )
+    if args.tile_size:
+        config["default_size"] = args.tile_size
+    if args.upscale:
+        config["upscale"] = args.upscale
+    if args.workers is not None:
+        config["workers"] = args.workers
+
+    # Libraries of other image sizes or formats get folders of their own
+    mix = {
+        "sizes": [list(size) for size in args.sizes],
+        "formats": list(args.formats),
+    }
+    tag = ""
+    if mix != library_mix(None):
+        tag = "-" + "_".join(f"{w}x{h}" for w, h in args.sizes) + "-" + "_".join(args.formats)
+
+    results = []
+    for count in args.libraries:
+        library = os.path.join(work, f"library-{count}-{args.seed}{tag}")
+        print(f"Library of {count} images: {library}")
+        make_library(library, count, args.seed, args.sizes, args.formats)
+
+        for _ in range(args.repeat):
+            for stage, seconds in ingest_timings(config, library).items():
+                record(results, stage, count, None, seconds)
+
+        for tiles in args.tiles:
+            # A square goal, so the tiles come out as a square grid of about that many
+            side = math.ceil(math.sqrt(tiles) * config["default_size"] / config["upscale"])
+            goal = os.path.join(work, f"goal-{side}-{args.seed}.png")
+            make_goal(goal, side, side, args.seed)
+            for _ in range(args.repeat):
+                timings, placed = build_timings(config, goal, os.path.join(run, "output.png"))
+                for stage, seconds in timings.items():
+                    record(results, stage, count, placed, seconds)
+
+        for result in results:
+            if result["library"] == count:
+                tiles = "" if result["tiles"] is None else f"{result['tiles']} tiles"
+                print(f"  {result['stage']:10} {tiles:>12} {result['best']:9.3f}s")
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "seed": args.seed,
+        "repeat": args.repeat,
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "cpus": os.cpu_count(),
+        },
+        "config": {key: config.get(key) for key in SETTINGS},
+        "library": mix,
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+def compare(args):
+    """Compare two suite runs, flagging stages that got slower."""
+    with open(args.old, encoding="utf-8") as f:
+        old = json.load(f)
+    with open(args.new, encoding="utf-8") as f:
+        new = json.load(f)
+
+    if old["config"] != new["config"]:
+        print("Warning: the runs used different settings, timings may not be comparable")
+    if library_mix(old) != library_mix(new):
+        print("Warning: the runs used different library image sizes or formats")
+    before = {(r["stage"], r["library"], r["tiles"]): r["best"] for r in old["results"]}
+
+    print("|   Stage    | Library |  Tiles  |   Old    |   New    | Change |")
+    print("|------------|---------|---------|----------|----------|--------|")
+    regressions = 0
+    for result in new["results"]:
+        key = (result["stage"], result["library"], result["tiles"])
+        if key not in before:
+            continue
+        was, now = before[key], result["best"]
+        change = (now - was) / was if was else 0.0
+        flag = ""
+        if now - was > args.floor and change > args.threshold:
+            flag = " SLOWER"
+            regressions += 1
+        elif was - now > args.floor and -change > args.threshold:
+            flag = " faster"
+        tiles = "" if result["tiles"] is None else result["tiles"]
+        print(
+            f"| {result['stage']:10} | {result['library']:7} | {tiles:>7} "
+            f"| {was:7.3f}s | {now:7.3f}s | {change:+6.0%} |{flag}"
+        )
+
+    if regressions:
+        print(f"\n{regressions} stages regressed by more than {args.threshold:.0%}")
+        sys.exit(1)
+    print("\nNo regressions")
+
+
+def library_mix(report):
+    """The image sizes and formats a suite run's libraries used.
+
+    Runs recorded before these were configurable used the defaults.
+    """
+    default = {"sizes": [list(size) for size in IMAGE_SIZES], "formats": list(FORMATS)}
+    return (report or {}).get("library", default)
+
+
+def sizes(text):
+    """A comma separated list of whole numbers."""
+    return [int(size) for size in text.split(",") if size]
+
+
+def dimensions(text):
+    """A comma separated list of WxH image sizes."""
+    try:
+        found = [tuple(int(side) for side in size.split("x")) for size in text.split(",") if size]
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(f"expected WxH,WxH,... not {text!r}") from err
+    if not found or any(len(size) != 2 for size in found):
+        raise argparse.ArgumentTypeError(f"expected WxH,WxH,... not {text!r}")
+    return found
+
+
+def formats(text):
+    """A comma separated list of image file extensions."""
+    return [fmt.lower().lstrip(".") for fmt in text.split(",") if fmt]
+
+
+def main():  # pylint: disable=missing-function-docstring
+    with open("config.yaml", encoding="utf-8") as f:
+        config = yaml.safe_load(f)
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    matching = commands.add_parser("matcher", help="nearest-color matching on random palettes")
+    matching.add_argument("seed", nargs="?", type=int, default=0)
+
+    running = commands.add_parser("suite", help="time every stage on synthetic libraries")
+    running.add_argument("--libraries", type=sizes, default=[200, 1000], metavar="N,N,...")
+    running.add_argument("--tiles", type=sizes, default=[1000, 10000], metavar="N,N,...")
+    running.add_argument(
+        "--sizes", type=dimensions, default=IMAGE_SIZES, metavar="WxH,WxH,...",
+        help="source image sizes the libraries mix",
+    )
+    running.add_argument(
+        "--formats", type=formats, default=FORMATS, metavar="EXT,EXT,...",
+        help="source image formats the libraries mix",
+    )
+    running.add_argument("--seed", type=int, default=0)
+    running.add_argument("--repeat", type=int, default=1, help="runs per stage, the best is kept")
+    running.add_argument("--tile-size", type=int, default=40, help="thumbnail width in pixels")
+    running.add_argument("--upscale", type=int, default=10)
+    running.add_argument("--workers", type=int, default=None)
+    running.add_argument("--workdir", default="data/bench", help="where libraries are kept")
+    running.add_argument("--output", default="benchmark.json", help="the JSON results file")
+
+    comparing = commands.add_parser("compare", help="flag regressions between two suite runs")
+    comparing.add_argument("old")
+    comparing.add_argument("new")
+    comparing.add_argument(
+        "--threshold", type=float, default=0.10, help="slowdown to flag (0.10 is 10%%)"
+    )
+    comparing.add_argument(
+        "--floor", type=float, default=0.05, help="ignore changes under this many seconds"
+    )
+
+    args = parser.parse_args()
+    if args.command == "matcher":
+        matcher_benchmark(args.seed)
+    elif args.command == "suite":
+        suite(config, args)
+    else:
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
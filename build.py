@@ -1,14 +1,20 @@
 #!/usr/bin/env python3
 """Building a montage image from the palette database and cached images."""
 
+import argparse
 import sys
 
-import pickledb
 import yaml
 
-from wand.image import Image
-
-from lib.montage import calculate_big_pixels, draw_pixelated, calculate_locations
+from lib.build import (
+    find_locations,
+    goal_layout,
+    parse_build_args,
+    write_montage,
+    write_pixelated,
+)
+from lib.montage import calculate_big_pixels
+from lib.store import PaletteStore
 
 
 with open("config.yaml", encoding="utf-8") as f:
@@ -16,53 +22,48 @@ with open("config.yaml", encoding="utf-8") as f:
 
 
 def main(
-    cache_file, goal_image, output_image
+    cache_file, goal_image, output_image, draft=0
 ):  # pylint: disable=missing-function-docstring
-    cache = pickledb.load(cache_file, False)
+    cache = PaletteStore(cache_file)
 
-    if cache.totalkeys() == 0:
-        print(f"NO CACHE: {sys.argv[1]}")
+    if len(cache) == 0:
+        print(f"NO CACHE: {cache_file}")
         sys.exit(1)
     else:
-        print(f"We have {cache.totalkeys()} potential pixel images")
+        print(f"We have {len(cache)} potential pixel images")
 
     # Calculate some basic sizes
-    img = {"ref": Image(filename=goal_image)}
-    img["out_width"] = img["ref"].width * config["upscale"]
-    img["out_height"] = img["ref"].height * config["upscale"]
-    img["height_ratio"] = img["ref"].height / img["ref"].width
-    img["pixel_width"] = config["default_size"]
-    img["pixel_height"] = int(config["default_size"] * img["height_ratio"])
-
-    print(f"Our output should be {img['out_width']} x {img['out_height']}")
-    print(f"Height ratio is {img['height_ratio']}")
+    img = goal_layout(config, goal_image)
 
     # "big pixels" are where smaller images will form pixels
-    bigpixels = calculate_big_pixels(img, config["upscale"])
-    draw_pixelated(img, bigpixels, "pixelated.jpg")
+    grid = config.get("signature_grid", 0)
+    if grid and cache.grid != grid:
+        print(f"The palette has no {grid}x{grid} signatures, rebuild it first")
+        sys.exit(1)
+    bigpixels = calculate_big_pixels(img, config["upscale"], grid)
+    write_pixelated(config, img, bigpixels, draft)
 
     # Find candidates to fill the big pixels
-    locations = calculate_locations(cache, bigpixels, config["color_distance"])
+    locations = find_locations(config, cache, bigpixels)
 
     # Write the montage
-    print(f"Writing the output image ({output_image}) of {len(bigpixels)} tiles")
-
-    with Image(width=img["out_width"], height=img["out_height"]) as out:
-        for file, points in locations.items():
-            print(f"{file} : ", end="")
-            new_pixel = Image(filename=file)
-            new_pixel.resize(height=img["pixel_height"], width=img["pixel_width"])
-
-            total_count = len(points)
-            count = 0
-            for point in points:
-                count += 1
-                out.composite(new_pixel, point[0], point[1])
-                print(f"\r{file} : {count} / {total_count}", end="")
-            print("")
-
-        out.save(filename=output_image)
+    write_montage(config, cache, img, bigpixels, locations, output_image, draft)
 
 
 if __name__ == "__main__":
-    main(sys.argv[1], sys.argv[2], sys.argv[3])
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("palette", help="the palette database")
+    parser.add_argument("goal", help="the image to build a montage of")
+    parser.add_argument(
+        "output", help="where to write the montage (a .dzi file writes a Deep Zoom pyramid)"
+    )
+    parser.add_argument(
+        "--render-workers",
+        type=int,
+        default=config.get("render_workers", 1),
+        metavar="N",
+        help="draw the montage over N processes (0 for one per core)",
+    )
+    args = parse_build_args(parser, config)
+    config["render_workers"] = args.render_workers
+    main(args.palette, args.goal, args.output, args.draft)
@@ -0,0 +1,269 @@
+""" Montage library: tile assignment with per-image usage limits and spacing
+
+Instead of matching every big pixel on its own, candidate (color, image)
+pairs are taken greedily from a priority queue ordered by distance.  Tiles
+of the same target color share one list of candidates, so a flat patch of
+the goal costs one lookup however many tiles it covers.  A pair hands the
+image to as many of the color's waiting tiles as it has uses left for,
+skipping tiles with a copy of the image already within ``min_spacing``.
+Colors whose candidates all run out are queued again, a little deeper,
+against the images that still have uses left.  Images that no color asked
+for offer themselves to their own nearest colors in the same queue, since
+where colors crowd together they all ask for the same few images.
+
+Once a pass places few of the tiles still waiting, the images left over
+mostly lie away from where the colors ran short, and deeper queues would
+only grow.  Without max_uses only spacing turns candidates down, so one
+pass is enough.  The rest are placed one color at a time instead, each
+tile on the nearest image it may still use, found through the palette
+index.  When there is none, because every image is used up or spacing
+rules out all that are left, the limit is dropped for that tile and a
+warning says how often that happened.
+"""
+
+import numpy as np
+
+from lib.matcher import ColorMatcher
+
+# Nearest palette colors queued per target color on the first pass
+FIRST_CANDIDATES = 4
+
+# Most nearest palette colors queued per target color, beyond what its own tiles need
+MOST_CANDIDATES = 16
+
+# Share of the tiles waiting before a pass that it must place to keep queueing
+SLOW_PASS = 0.25
+
+# Most candidates asked for in all by one round of placing the colors left one at a time
+ROUND_CANDIDATES = 1 << 22
+
+
+def assign_tiles(  # pylint: disable=R0913,R0914,R0915
+    matcher, targets, grid, max_uses=0, min_spacing=0, rng=None
+):
+    """ Given target colors and their (column, row) tile positions, pick an image for every tile
+
+    A max_uses or min_spacing of zero means no limit.  Returns the chosen
+    palette rows, their distances, and the unconstrained nearest distances.
+    """
+    rng = rng or np.random.default_rng()
+    targets = np.array(targets, dtype=np.float64, ndmin=2)
+    grid = np.asarray(grid, dtype=np.intp)
+
+    # Tiles of one color wait together, shuffled so ties between them fall at random
+    order = rng.permutation(len(targets))
+    colors, inverse = np.unique(targets[order], axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    waiting = [
+        tiles.tolist()
+        for tiles in np.split(
+            order[np.argsort(inverse, kind="stable")], np.cumsum(np.bincount(inverse))[:-1]
+        )
+    ]
+
+    state = Placement(len(targets), len(matcher), grid, max_uses, min_spacing)
+    depth = np.full(len(colors), FIRST_CANDIDATES, dtype=np.intp)
+    closest = np.zeros(len(colors), dtype=np.float64)
+    left = np.arange(len(colors))
+    baseline = None
+    while len(left):
+        alive = np.flatnonzero(state.open)
+        if len(alive) == 0:
+            break
+        index = matcher if len(alive) == len(matcher) else ColorMatcher(matcher.colors[alive])
+
+        # A color asks for enough images to fill all of its tiles, and for at least its depth
+        need = np.array([len(waiting[c]) for c in left.tolist()])
+        before = need.sum()
+        if max_uses:
+            need = -(-need // max_uses)
+        want = np.minimum(np.maximum(depth[left], need), len(alive))
+        owners, rows, dist = [], [], []
+        for k in np.unique(want).tolist():
+            group = left[want == k]
+            found, far = index.nearest(colors[group], k)
+            closest[group] = far[:, 0]
+            owners.append(np.repeat(group, k))
+            rows.append(alive[found].ravel())
+            dist.append(far.ravel())
+        if baseline is None:
+            # The first pass asks every color of the whole palette, nearest first
+            baseline = closest.copy()
+
+        # Images no color asked for offer themselves to their own nearest colors
+        unasked = np.setdiff1d(alive, np.concatenate(rows)) if max_uses else alive[:0]
+        if len(unasked):
+            found, far = ColorMatcher(colors[left]).nearest(
+                matcher.colors[unasked], min(len(left), FIRST_CANDIDATES)
+            )
+            owners.append(left[found].ravel())
+            rows.append(np.repeat(unasked, found.shape[1]))
+            dist.append(far.ravel())
+        owners = np.concatenate(owners)
+        rows = np.concatenate(rows)
+        dist = np.concatenate(dist)
+
+        # Closest pairs first; random keys break ties between equal distances
+        queue = np.lexsort((rng.random(len(dist)), dist))
+        placed = 0
+        for owner, row, gap in zip(
+            owners[queue].tolist(), rows[queue].tolist(), dist[queue].tolist()
+        ):
+            if waiting[owner]:
+                placed += state.place(waiting[owner], row, gap)
+
+        # Every candidate of a color still waiting was turned down, and stays turned down as
+        # uses and neighbours only grow, so those colors ask deeper next time
+        left = np.array([c for c in left.tolist() if waiting[c]], dtype=np.intp)
+        depth[left] = np.minimum(depth[left] * 4, MOST_CANDIDATES)
+        if not max_uses:
+            # Without max_uses no color uses images up for another, so only spacing turned
+            # these down, and placing them one at a time checks it more cheaply
+            break
+        if placed < before * SLOW_PASS and (depth[left] >= MOST_CANDIDATES).all():
+            break
+
+    # Colors nearest their images go first, as they would have in the queue
+    left = left[np.argsort(closest[left], kind="stable")]
+    state.finish(matcher, colors[left], [waiting[color] for color in left.tolist()])
+    state.warn()
+
+    spot = np.empty_like(inverse)
+    spot[order] = inverse
+    return state.chosen, state.delta, baseline[spot]
+
+
+class Placement:  # pylint: disable=too-many-instance-attributes
+    """ Tiles placed so far, and how often and where each image is used """
+
+    def __init__(self, tiles, images, grid, max_uses, spacing):  # pylint: disable=R0913
+        self.chosen = np.full(tiles, -1, dtype=np.intp)
+        self.delta = np.zeros(tiles, dtype=np.float64)
+        self.uses = np.zeros(images, dtype=np.intp)
+        self.open = np.ones(images, dtype=bool)
+        self.cells = [tuple(cell) for cell in grid.tolist()]
+        self.occupant = np.full(tuple(grid.max(axis=0) + 1), -1, dtype=np.intp)
+        self.max_uses = max_uses
+        self.spacing = spacing
+        self.limit = max_uses
+        self.reused = False
+        self.overused = 0
+        self.crowded = 0
+
+    def put(self, tile, row, gap):
+        """ Put the image on the tile """
+        self.chosen[tile] = row
+        self.delta[tile] = gap
+        self.occupant[self.cells[tile]] = row
+        self.uses[row] += 1
+        self.overused += self.reused
+        if self.limit and self.uses[row] >= self.limit:
+            self.open[row] = False
+
+    def place(self, tiles, row, gap):
+        """ Hand the image to as many waiting tiles as it has uses left for
+
+        Placed tiles are taken off the list, and the number placed returned.
+        """
+        room = self.limit - int(self.uses[row]) if self.limit else len(tiles)
+        placed = 0
+        skipped = []
+        while tiles and placed < room:
+            tile = tiles.pop()
+            if self.uses[row] and self.spacing and crowded(
+                self.occupant, self.cells[tile], row, self.spacing
+            ):
+                skipped.append(tile)
+                continue
+            self.put(tile, row, gap)
+            placed += 1
+        tiles.extend(skipped)
+        return placed
+
+    def finish(self, matcher, colors, waiting):  # pylint: disable=R0914
+        """ Put every waiting tile, a color at a time, on the nearest image it may still use
+
+        Colors take turns in rounds, all asking the images with uses left for
+        their nearest few in one query.  A color whose few are used up or
+        crowd its tiles waits for the next round, which asks again for as
+        many more as ROUND_CANDIDATES allows.  Once a round asks for every
+        image, a tile they all crowd takes the nearest anyway, and once every
+        image is used up they all get enough more uses for the tiles left.
+        """
+        k = MOST_CANDIDATES
+        left = list(range(len(colors)))
+        while left:
+            before = sum(len(waiting[color]) for color in left)
+            if not self.open.any():
+                self.reopen(before)
+            rows = np.flatnonzero(self.open)
+            index = matcher if len(rows) == len(matcher) else ColorMatcher(matcher.colors[rows])
+            found, far = index.nearest(colors[left], k)
+            every = found.shape[1] == len(rows)
+            for color, near, gaps in zip(left, rows[found], far):
+                keep = self.open[near]
+                self.settle(waiting[color], near[keep].tolist(), gaps[keep].tolist(), every)
+            left = [color for color in left if waiting[color]]
+            if sum(len(waiting[color]) for color in left) == before:
+                k *= 4
+            elif left:
+                k = max(k, min(k * 4, ROUND_CANDIDATES // len(left)))
+
+    def reopen(self, tiles):
+        """ Give every image enough more uses for the tiles left, once all are used up """
+        rounds = -(-tiles // (len(self.uses) * self.max_uses))
+        self.limit += self.max_uses * rounds
+        self.open = self.uses < self.limit
+        self.reused = True
+
+    def settle(self, tiles, near, gaps, every):
+        """ Put waiting tiles on the nearest of the near images that does not crowd them
+
+        Near images run closest first.  When they are every image with uses
+        left, a tile they all crowd takes the nearest.
+        """
+        while tiles and near:
+            pick = self.free(tiles[-1], near)
+            if pick < 0:
+                if not every:
+                    return
+                self.crowded += 1
+                pick = 0
+            row = near[pick]
+            self.put(tiles.pop(), row, gaps[pick])
+            if not self.open[row]:
+                del near[pick], gaps[pick]
+
+    def free(self, tile, near):
+        """ Index of the first near image not crowding the tile, or -1 if they all do """
+        if not self.spacing:
+            return 0
+        taken = set(neighbours(self.occupant, self.cells[tile], self.spacing).ravel().tolist())
+        for pick, row in enumerate(near):
+            if row not in taken:
+                return pick
+        return -1
+
+    def warn(self):
+        """ Say how often the limits had to be dropped """
+        if self.overused:
+            print(
+                f"Warning: {self.overused} tiles found every image used {self.max_uses} times, "
+                "so they reuse images beyond max_uses"
+            )
+        if self.crowded:
+            print(
+                f"Warning: {self.crowded} tiles found no image outside min_spacing of "
+                "its other copies, so they break the spacing"
+            )
+
+
+def neighbours(occupant, cell, spacing):
+    """ The images placed within spacing tiles of cell """
+    x, y = cell
+    return occupant[max(x - spacing, 0) : x + spacing + 1, max(y - spacing, 0) : y + spacing + 1]
+
+
+def crowded(occupant, cell, row, spacing):
+    """ Check if the image is already placed within spacing tiles of cell """
+    return row in neighbours(occupant, cell, spacing)
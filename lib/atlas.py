@@ -0,0 +1,77 @@
+""" Montage library: memory-mapped atlas of thumbnails pre-sized to the tile size
+
+The atlas is one (N, height, width, 3) uint8 array aligned with the rows of
+the palette, saved as ``<palette>.atlas-<W>x<H>.npy``.  A small JSON stamp
+alongside records the palette version and tile size it was built for, and
+the atlas is rebuilt whenever either of those change.
+"""
+
+import json
+import os
+
+from functools import partial
+
+import numpy as np
+
+from lib.parallel import parallel_map
+from lib.render import load_tile
+from lib import trace
+
+
+class TileAtlas:
+    """ Pre-sized tiles for every palette entry """
+
+    def __init__(self, palette, width, height):
+        self.palette = palette
+        self.width = width
+        self.height = height
+        self.path = f"{palette.path}.atlas-{width}x{height}.npy"
+        self.stamp_file = f"{self.path}.json"
+        self.tiles = None
+
+    def stamp(self):
+        """ What the atlas has to be rebuilt for when it changes
+
+        A thumbnail made again is written to the palette as well, so the
+        palette version covers changed thumbnails without the manifest.
+        """
+        return {"palette": self.palette.version, "width": self.width, "height": self.height}
+
+    def current(self):
+        """ Check if the atlas on disk was built from the current thumbnails """
+        if not os.path.exists(self.path) or not os.path.exists(self.stamp_file):
+            return False
+        with open(self.stamp_file, encoding="utf-8") as f:
+            return json.load(f) == self.stamp()
+
+    def load(self, workers=0):
+        """ Map the atlas, building it first if it is missing or out of date """
+        if not self.current():
+            self.build(workers)
+        self.tiles = np.load(self.path, mmap_mode="r")
+        return self
+
+    @trace.span("atlas")
+    def build(self, workers=0):
+        """ Decode and resize every palette thumbnail into a fresh atlas """
+        print(f"Building {self.width}x{self.height} tile atlas of {len(self.palette)} images")
+        tiles = np.lib.format.open_memmap(
+            f"{self.path}.tmp",
+            mode="w+",
+            dtype=np.uint8,
+            shape=(len(self.palette), self.height, self.width, 3),
+        )
+        resize = partial(load_tile, width=self.width, height=self.height)
+        for row, tile in enumerate(parallel_map(resize, self.palette.paths, workers)):
+            tiles[row] = tile
+        trace.count("atlas tiles", len(self.palette))
+        tiles.flush()
+        del tiles
+
+        os.replace(f"{self.path}.tmp", self.path)
+        with open(self.stamp_file, "w", encoding="utf-8") as f:
+            json.dump(self.stamp(), f)
+
+    def tile(self, file):
+        """ The pre-sized tile for a palette path """
+        return self.tiles[self.palette.index[file]]
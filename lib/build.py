@@ -0,0 +1,203 @@
+""" Montage library: the steps of building a montage, shared by build.py and the pipeline """
+
+import os
+
+import numpy as np
+
+from wand.image import Image
+
+from lib.atlas import TileAtlas
+from lib.lut import ColorLUT
+from lib.montage import calculate_locations
+from lib.pyramid import pyramid_writer
+from lib.render import (
+    montage_bands,
+    pixelated,
+    render_montage,
+    save_pixels,
+    stream_montage,
+    stream_pixelated,
+)
+from lib.shard import shard_montage
+from lib.signature import SignatureIndex
+from lib.tint import Tint
+from lib import trace
+
+# Config keys that change how a montage is built from the palette, but not the palette itself
+BUILD_KEYS = (
+    "default_size",
+    "upscale",
+    "color_distance",
+    "match_mode",
+    "lab_distance",
+    "lut_bits",
+    "max_uses",
+    "min_spacing",
+    "seed",
+    "stream",
+    "tint_mode",
+    "tint_strength",
+)
+
+# Config keys the match indexes are built from
+INDEX_KEYS = ("match_mode", "lab_distance", "lut_bits", "signature_grid")
+
+
+def parse_build_args(parser, config):
+    """ Add the --draft, --trace and --quiet options the build scripts share, then parse them
+
+    Tracing and quiet mode are turned on as the command line and config say.
+    """
+    parser.add_argument(
+        "--draft",
+        nargs="?",
+        type=int,
+        const=8,
+        default=0,
+        metavar="SCALE",
+        help="only write quick previews at 1/SCALE size (8 if not given), beside the output",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="write per-stage timings, counters and peak memory here as a Chrome trace",
+    )
+    parser.add_argument(
+        "--quiet",
+        action="store_true",
+        default=None,
+        help="print periodic summaries instead of a line per item",
+    )
+    args = parser.parse_args()
+    trace.setup(config, args.trace, args.quiet)
+    return args
+
+
+@trace.span("goal")
+def goal_layout(config, goal_image):
+    """ Given the goal image, calculate the output and tile sizes """
+    img = {"ref": Image(filename=goal_image)}
+    trace.count("images decoded")
+    trace.count("bytes read", os.path.getsize(goal_image))
+    img["out_width"] = img["ref"].width * config["upscale"]
+    img["out_height"] = img["ref"].height * config["upscale"]
+    img["height_ratio"] = img["ref"].height / img["ref"].width
+    img["pixel_width"] = config["default_size"]
+    img["pixel_height"] = int(config["default_size"] * img["height_ratio"])
+
+    print(f"Our output should be {img['out_width']} x {img['out_height']}")
+    print(f"Height ratio is {img['height_ratio']}")
+    return img
+
+
+@trace.span("pixelated")
+def write_pixelated(config, img, bigpixels, draft=0):
+    """ Write the flat-color reference, at 1/draft size for a draft; returns its file name """
+    if draft:
+        print("Writing pixelated draft for reference: pixelated-draft.png")
+        save_pixels(pixelated(img, bigpixels, draft), "pixelated-draft.png")
+        return "pixelated-draft.png"
+    if config.get("stream"):
+        stream_pixelated(img, bigpixels, "pixelated.png")
+        return "pixelated.png"
+    print("Writing pixelated output for reference: pixelated.jpg")
+    save_pixels(pixelated(img, bigpixels), "pixelated.jpg")
+    return "pixelated.jpg"
+
+
+@trace.span("indexes")
+def match_indexes(config, cache):
+    """ The Lab lookup table and signature index the config asks for, loading or building them
+
+    Returns (lut, signatures), either of which may be None.
+    """
+    grid = config.get("signature_grid", 0)
+    if grid and cache.grid != grid:
+        raise ValueError(f"The palette has no {grid}x{grid} signatures, rebuild it first")
+    if grid:
+        return None, SignatureIndex(cache).load()
+    if config.get("match_mode") == "lab":
+        return ColorLUT(cache, config["lab_distance"], config.get("lut_bits", 5)).load(), None
+    return None, None
+
+
+@trace.span("match")
+def find_locations(config, cache, bigpixels, indexes=None, matcher=None):
+    """ Pick the image for every big pixel, as calculate_locations does, per the config
+
+    Indexes are the (lut, signatures) from match_indexes, loaded if not given.
+    With a seed in the config, the same inputs always get the same tiles.
+    """
+    lut, signatures = indexes if indexes is not None else match_indexes(config, cache)
+    return calculate_locations(
+        cache,
+        bigpixels,
+        config["color_distance"],
+        lut,
+        config.get("max_uses", 0),
+        config.get("min_spacing", 0),
+        signatures,
+        matcher,
+        np.random.default_rng(config.get("seed")),
+    )
+
+
+@trace.span("render")
+def write_montage(  # pylint: disable=R0913
+    config, cache, img, bigpixels, locations, output_image, draft=0, tile_for=None
+):
+    """ Render the placed tiles out to output_image, or beside it for a draft
+
+    Tiles come from tile_for, a function of the file giving its full-size
+    tile, when given; otherwise a full render may be spread over
+    render_workers processes.  An output_image ending in .dzi is written
+    as a Deep Zoom tile pyramid, a band at a time.  Streaming is only done
+    for a .png output.  Returns the file name written.
+    """
+    if draft:
+        stem, ext = os.path.splitext(output_image)
+        output_image = f"{stem}-draft{ext}"
+    print(f"Writing the output image ({output_image}) of {len(bigpixels)} tiles")
+
+    # Streaming only encodes PNG, so any other format is drawn in memory and saved whole
+    if config.get("stream") and os.path.splitext(output_image)[1].lower() not in (".png", ".dzi"):
+        print(f"Warning: stream only writes PNG, so {output_image} is drawn in memory instead")
+        config = dict(config, stream=False)
+
+    atlas = None
+    if config.get("atlas") and tile_for is None:
+        atlas = TileAtlas(cache, img["pixel_width"], img["pixel_height"]).load(
+            config.get("workers", 0)
+        )
+
+    tint = None
+    if config.get("tint_mode", "none") != "none":
+        tint = Tint(
+            config["tint_mode"], config.get("tint_strength", 0.25), img, bigpixels, draft or 1
+        )
+
+    if draft:
+        pixels = render_montage(img, locations, atlas, draft, tint, tile_for)
+        if output_image.endswith(".dzi"):
+            with pyramid_writer(config, output_image, pixels.shape[1], pixels.shape[0]) as out:
+                out.write(pixels)
+        else:
+            save_pixels(pixels, output_image)
+    elif config.get("render_workers", 1) != 1 and tile_for is None:
+        shard_montage(
+            config, img, locations, output_image, tint, config["render_workers"], atlas
+        )
+    elif output_image.endswith(".dzi"):
+        with pyramid_writer(config, output_image, img["out_width"], img["out_height"]) as out:
+            for band in montage_bands(
+                img, locations, atlas, config.get("tile_cache", 1024), tint, tile_for
+            ):
+                out.write(band)
+    elif config.get("stream"):
+        stream_montage(
+            img, locations, output_image, atlas, config.get("tile_cache", 1024), tint, tile_for
+        )
+    else:
+        pixels = render_montage(img, locations, atlas, tint=tint, tile_for=tile_for)
+        save_pixels(pixels, output_image)
+    return output_image
@@ -0,0 +1,236 @@
+""" Montage library: collapsing near-duplicate thumbnails by difference hash
+
+Thumbnails are visited in path order and looked up in a multi-index hash
+of the representatives chosen so far.  One within ``radius`` bits joins
+that representative's cluster, anything else becomes a representative
+itself.  Hashes are cut into m chunks, and two hashes within radius bits
+must have some chunk within radius // m bits of each other, so a lookup
+only probes the table keys that close to its own chunks and measures the
+representatives found there rather than all of them.  The number of
+chunks is picked for the library size: more, narrower chunks need fewer
+keys probed but find more representatives behind each key.
+
+Clusters found on an earlier run can be passed back in, and only the
+thumbnails they do not place are looked up.
+"""
+
+from itertools import combinations
+from math import comb
+
+import numpy as np
+
+# Bits in the hashes being indexed
+HASH_BITS = 64
+
+# Probed keys and measured hashes to aim for per batch of lookups
+BATCH_CELLS = 1 << 21
+
+# Measured hashes that probing one key costs about as much as, for its two binary searches
+PROBE_COST = 8
+
+# Most lookups per batch; each is also measured against the others in its batch
+MOST_BATCH = 1 << 10
+
+
+class HashIndex:  # pylint: disable=too-many-instance-attributes
+    """ Multi-index hash over 64-bit hashes under Hamming distance
+
+    Every table holds one chunk of each hash, sorted, so a batch of lookups
+    finds the hashes behind all of its probed keys in one search.
+    """
+
+    def __init__(self, radius, size):
+        self.radius = radius
+        count = chunk_count(radius, size)
+        self.widths = chunk_widths(count)
+        self.shifts = [sum(self.widths[:i]) for i in range(count)]
+        self.batch = int(min(MOST_BATCH, max(1, BATCH_CELLS // lookup_cost(radius, size, count))))
+
+        # Every way of flipping up to radius // chunks bits of a key, per key width
+        reach = radius // count
+        self.flips = {
+            bits: np.array(
+                [
+                    sum(1 << bit for bit in flipped)
+                    for flips in range(reach + 1)
+                    for flipped in combinations(range(bits), flips)
+                ],
+                dtype=np.uint64,
+            )
+            for bits in set(self.widths)
+        }
+
+        self.digests = np.empty(0, dtype=np.uint64)
+        self.items = np.empty(0, dtype=np.intp)
+        self.tables = [
+            (np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.intp)) for _ in self.widths
+        ]
+
+    def keys(self, digests):
+        """ The chunk of every hash that goes in each table """
+        return [
+            (digests >> np.uint64(shift)) & np.uint64((1 << bits) - 1)
+            for shift, bits in zip(self.shifts, self.widths)
+        ]
+
+    def add(self, digests, items):
+        """ Insert items under their hashes """
+        rows = np.arange(len(self.digests), len(self.digests) + len(digests))
+        self.digests = np.concatenate([self.digests, digests])
+        self.items = np.concatenate([self.items, items])
+        for i, key in enumerate(self.keys(digests)):
+            table, order = self.tables[i]
+            new = np.argsort(key, kind="stable")
+            spots = np.searchsorted(table, key[new], side="right")
+            self.tables[i] = (np.insert(table, spots, key[new]), np.insert(order, spots, rows[new]))
+
+    def search(self, digests):
+        """ The closest item within radius bits of each hash, and its distance
+
+        Ties go to the lowest item.  A hash with nothing that close gets
+        item -1 at distance radius + 1.
+        """
+        query, rows = self.probe(digests)
+        dist = np.bitwise_count(digests[query] ^ self.digests[rows]).astype(np.intp)
+        near = dist <= self.radius
+        query, items, dist = query[near], self.items[rows[near]], dist[near]
+
+        best = np.full(len(digests), self.radius + 1, dtype=np.intp)
+        found = np.full(len(digests), -1, dtype=np.intp)
+        order = np.lexsort((items, dist, query))
+        hit, first = np.unique(query[order], return_index=True)
+        best[hit] = dist[order[first]]
+        found[hit] = items[order[first]]
+        return best, found
+
+    def probe(self, digests):
+        """ (lookup, row) pairs for the hashes sharing a probed key with a lookup in some table """
+        lookups = np.arange(len(digests))
+        queries, rows = [], []
+        for (table, order), bits, key in zip(self.tables, self.widths, self.keys(digests)):
+            probes = (key[:, None] ^ self.flips[bits][None, :]).ravel()
+
+            # Sorted keys search far faster, each picking up where the last left off
+            ranked = np.argsort(probes)
+            lo = np.empty(len(probes), dtype=np.intp)
+            lens = np.empty(len(probes), dtype=np.intp)
+            lo[ranked] = np.searchsorted(table, probes[ranked], side="left")
+            lens[ranked] = np.searchsorted(table, probes[ranked], side="right")
+            lens -= lo
+            offsets = np.repeat(lo - np.cumsum(lens) + lens, lens) + np.arange(lens.sum())
+            queries.append(np.repeat(lookups, lens.reshape(len(digests), -1).sum(axis=1)))
+            rows.append(order[offsets])
+        return np.concatenate(queries), np.concatenate(rows)
+
+
+def chunk_widths(count):
+    """ Bits per chunk when hashes are cut into count chunks as evenly as they go """
+    return [HASH_BITS // count + (i < HASH_BITS % count) for i in range(count)]
+
+
+def lookup_cost(radius, size, count):
+    """ Work of one lookup among size random hashes cut into count chunks, in hashes measured """
+    reach = radius // count
+    return sum(
+        sum(comb(bits, flips) for flips in range(reach + 1)) * (PROBE_COST + size / (1 << bits))
+        for bits in chunk_widths(count)
+    )
+
+
+def chunk_count(radius, size):
+    """ How many chunks make a lookup cheapest in an index of about size hashes
+
+    Radius + 1 chunks need only the exact keys probed, but are narrow
+    enough that a large library crowds many hashes behind every one.
+    """
+    return min(
+        range(1, min(radius + 1, HASH_BITS) + 1),
+        key=lambda count: lookup_cost(radius, size, count),
+    )
+
+
+def cluster(hashes, radius, known=None):  # pylint: disable=R0914
+    """ Given {item: hash}, group items within radius bits of a representative
+
+    Known is {item: (representative, distance)} from an earlier run at the
+    same radius, leaving out items whose hash has changed since.  Items
+    there whose representative is still one keep their place, and only the
+    rest are looked up.  Returns {representative: [(item, distance), ...]}
+    where every cluster lists its representative first, at distance 0.
+    """
+    known = known or {}
+    names = sorted(hashes)
+    clusters = {
+        item: [(item, 0)]
+        for item in names
+        if item in known and known[item][0] == item
+    }
+    placed = set(clusters)
+    for item in names:
+        representative, dist = known.get(item, (None, 0))
+        if item != representative and representative in clusters:
+            clusters[representative].append((item, dist))
+            placed.add(item)
+
+    pending = [item for item in names if item not in placed]
+    if not radius:
+        clusters.update((item, [(item, 0)]) for item in pending)
+        return clusters
+    if not pending:
+        return clusters
+
+    # Items are ranked in path order, so ties go to the earliest representative
+    rank = {item: i for i, item in enumerate(names)}
+    index = HashIndex(radius, len(hashes))
+    index.add(
+        np.array([hashes[item] for item in clusters], dtype=np.uint64),
+        np.array([rank[item] for item in clusters], dtype=np.intp),
+    )
+
+    digests = np.array([hashes[item] for item in pending], dtype=np.uint64)
+    for start in range(0, len(pending), index.batch):
+        batch = digests[start : start + index.batch]
+        dist, found = index.search(batch)
+
+        # Representatives made earlier in the batch are not in the index yet, so the
+        # few items near an earlier one of the batch are settled in order
+        inner = np.bitwise_count(batch[:, None] ^ batch[None, :]).astype(np.intp)
+        inner = np.where(np.tri(len(batch), k=-1, dtype=bool), inner, radius + 1)
+        fresh = dist > radius
+        for i in np.flatnonzero((inner <= radius).any(axis=1)).tolist():
+            earlier = np.flatnonzero(fresh[:i] & (inner[i, :i] <= radius))
+            if len(earlier) == 0:
+                continue
+            closest = earlier[inner[i, earlier].argmin()]
+            ranked = rank[pending[start + closest]]
+            if (inner[i, closest], ranked) < (dist[i], found[i]):
+                dist[i], found[i] = inner[i, closest], ranked
+            fresh[i] = False
+
+        items = pending[start : start + index.batch]
+        for item, new, best, representative in zip(
+            items, fresh.tolist(), dist.tolist(), found.tolist()
+        ):
+            if new:
+                clusters[item] = [(item, 0)]
+            else:
+                clusters[names[representative]].append((item, best))
+        index.add(
+            batch[fresh], np.array([rank[item] for item in items], dtype=np.intp)[fresh]
+        )
+    return clusters
+
+
+def write_report(clusters, sources, filename):
+    """ Write out every cluster that collapsed more than one thumbnail
+
+    Each representative is listed with its source, followed by the
+    duplicates dropped in its favour and how many bits they differ by.
+    """
+    collapsed = {rep: members for rep, members in clusters.items() if len(members) > 1}
+    with open(filename, "w", encoding="utf-8") as f:
+        for representative, members in sorted(collapsed.items()):
+            f.write(f"{sources.get(representative, '?')} ({representative})\n")
+            for item, dist in members[1:]:
+                f.write(f"    {dist:2} bits : {sources.get(item, '?')} ({item})\n")
+    return sum(len(members) - 1 for members in collapsed.values())
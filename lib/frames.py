@@ -0,0 +1,134 @@
+""" Montage library: thumbnails drawn from the frames of movies and animations
+
+Videos are decoded in a single pass by an ffmpeg pipe and streamed through
+a generator, so a feature film never has to be dumped to disk first.  Every
+Nth frame is kept, along with the first frame after a scene change, and a
+frame whose difference hash is within a few bits of the last kept one is
+dropped.  Kept frames are thumbnailed straight from memory as
+``<md5>-<frame>``.
+"""
+
+import os
+import subprocess
+import tempfile
+
+from wand.image import Image
+
+from lib.montage import dhash, hamming, palette_row, thumb_size
+
+ANIMATIONS = ('.gif', '.apng', '.mng')
+VIDEOS = ('.avi', '.m4v', '.mkv', '.mov', '.mp4', '.mpeg', '.mpg', '.webm')
+
+# The ffmpeg binary videos are decoded with, as ImageMagick's video delegate uses
+FFMPEG = "ffmpeg"
+
+# How many times per step to look for a scene change
+SCENE_CHECKS = 4
+
+
+def is_movie(name):
+    """ Given a file name, check the extension to see if we can draw frames from it """
+    return name.lower().endswith(ANIMATIONS + VIDEOS)
+
+
+def read_frames(path, scan=1):
+    """ Yield (index, image) for every scan-th frame of a movie or animation
+
+    Videos are decoded once, front to back, by ffmpeg, which drops the
+    frames in between and hands the rest over one at a time, so only one
+    frame is in memory at once.  Animations are read whole and coalesced,
+    since their frames may only hold what changed, so a long animation is
+    held in memory in full while its frames are drawn.
+    """
+    name = str(path)
+    if name.lower().endswith(ANIMATIONS):
+        with Image(filename=name) as movie:
+            movie.coalesce()
+            for index in range(0, len(movie.sequence), scan):
+                with Image(image=movie.sequence[index]) as frame:
+                    yield index, frame
+        return
+
+    # Every scan-th frame, numbered as in the film, out as a stream of PPM images
+    command = [FFMPEG, "-v", "error", "-nostdin", "-i", name, "-an", "-sn"]
+    command += ["-vf", f"select=not(mod(n\\,{scan}))", "-vsync", "0"]
+    command += ["-f", "image2pipe", "-vcodec", "ppm", "-"]
+    count = 0
+    with tempfile.TemporaryFile() as errors:
+        with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=errors) as ffmpeg:
+            try:
+                for blob in ppm_frames(ffmpeg.stdout):
+                    with Image(blob=blob, format="ppm") as frame:
+                        yield count * scan, frame
+                    count += 1
+            finally:
+                # Stopped early, or failed: don't wait on the rest of the film
+                if ffmpeg.poll() is None:
+                    ffmpeg.kill()
+
+        # Like a damaged tail, a failure after some frames just ends the film there
+        if ffmpeg.returncode and not count:
+            errors.seek(0)
+            message = errors.read().decode("utf-8", "replace").strip()
+            raise RuntimeError(f"ffmpeg could not decode {name}: {message}")
+
+
+def ppm_frames(stream):
+    """ Split a stream of binary PPM images, as ffmpeg writes them, yielding each whole """
+    while True:
+        magic = stream.readline()
+        if not magic:
+            return
+        size = stream.readline()
+        depth = stream.readline()
+        width, height = map(int, size.split())
+        length = width * height * 3 * (2 if int(depth) > 255 else 1)
+        pixels = stream.read(length)
+        if len(pixels) < length:
+            return
+        yield magic + size + depth + pixels
+
+
+def sample_frames(path, step, scene=0, dedupe=0):
+    """ Yield (index, image) for the frames worth keeping from a movie
+
+    A frame is due every step frames, or as soon as its hash is at least
+    scene bits away from the frame looked at before it.  A due frame within
+    dedupe bits of the last kept frame is skipped.  Zero turns either off.
+    """
+    scan = max(1, step // SCENE_CHECKS) if scene else step
+    last_index = last_hash = previous = None
+    for index, frame in read_frames(path, scan):
+        digest = dhash(frame)
+        cut = scene and previous is not None and hamming(digest, previous) >= scene
+        previous = digest
+
+        due = last_index is None or index - last_index >= step
+        if not (due or cut):
+            continue
+        if dedupe and last_hash is not None and hamming(digest, last_hash) <= dedupe:
+            continue
+
+        last_index, last_hash = index, digest
+        yield index, frame
+
+
+def frame_thumbnails(  # pylint: disable=R0913
+    path, outfile, height_ratio, pref_width, pref_height, grid=0, sampling=(1, 0, 0)
+):
+    """ Thumbnail the kept frames of a movie, as ``<outfile stem>-<frame><ext>``
+
+    Sampling is the (step, scene, dedupe) passed on to sample_frames.
+    Yields the (frame, thumbnail file, palette row, difference hash) of
+    every kept frame.
+    """
+    stem, ext = os.path.splitext(outfile)
+    for index, frame in sample_frames(path, *sampling):
+        frame.resize(*thumb_size(frame.width, frame.height, height_ratio, pref_width, pref_height))
+        frame.crop(height=pref_height, width=pref_width, gravity='center')
+        row, _ = palette_row(frame, grid)
+        digest = dhash(frame)
+
+        thumb = f"{stem}-{index}{ext}"
+        frame.save(filename=thumb)
+        yield index, thumb, row, digest
@@ -0,0 +1,214 @@
+""" Montage library: ingesting source images into thumbnails and the palette """
+
+import hashlib
+import os
+
+from pathlib import Path
+
+from lib.dedupe import cluster, write_report
+from lib.frames import frame_thumbnails, is_movie
+from lib.manifest import ThumbManifest
+from lib.montage import is_image
+from lib.palette import analyze_images
+from lib.store import CHANNELS, PaletteStore
+from lib.thumbs import make_thumbnails
+from lib import trace
+
+# New palette rows are written out in batches of this many as thumbnails land
+PALETTE_BATCH = 256
+
+
+def crawl_sources(imagedir, movies=False):
+    """ Yield source images in imagedir, and movies too if asked, as they are found """
+    for path in Path(imagedir).rglob("*"):
+        if not path.is_file():
+            continue
+        if is_image(path.name) or (movies and is_movie(path.name)):
+            yield path
+
+
+def scan_sources(imagedir, movies=False):
+    """ Crawl imagedir for source images, and movies too if asked, in path order """
+    return sorted(crawl_sources(imagedir, movies))
+
+
+@trace.span("ingest")
+def ingest(  # pylint: disable=R0912,R0914,R0915
+    config, sources, height_ratio, progress=None
+):
+    """ Bring the thumbnails and palette up to date with the given source paths
+
+    Only new or changed sources are thumbnailed, and thumbnails of sources
+    no longer given are removed.  Sources may be a lazy crawl: thumbnails
+    are made while it goes on, and their palette rows are written as they
+    land.  Progress, if given, is called as progress(stage, done, total)
+    for the "scan", "thumb" and "palette" stages, and may raise to abort.
+    Returns the updated palette.
+    """
+    report = progress or (lambda stage, done, total=0: None)
+    pref_width = config["default_size"]
+    pref_height = int(config["default_size"] * height_ratio)
+
+    if not trace.quiet():
+        print(
+            "/-----------------------------------------------------------------------------\\"
+        )
+        print(
+            "|         Filename         | Start Size | End Size |          Status          |"
+        )
+        print(
+            "|--------------------------|------------|----------|--------------------------|"
+        )
+
+    grid = config.get("signature_grid", 0)
+    palette = PaletteStore(config["palette"])
+    if len(palette) and palette.grid != grid:
+        print(f"Signature grid changed from {palette.grid} to {grid}, rebuilding the palette")
+        palette.write([], [], CHANNELS * (1 + grid * grid))
+
+    manifest = ThumbManifest(
+        config["thumbdir"],
+        {"width": pref_width, "height": pref_height, "type": config["thumbnail_type"]},
+        config.get("thumb_hash", False),
+    )
+
+    seen = set()
+    stats = {}
+    movies = []
+    frame_step = config.get("frame_step", 0)
+
+    def jobs():
+        """Sources that need a new thumbnail"""
+        for path in sources:
+            seen.add(str(path))
+            report("scan", len(seen))
+            movie = frame_step and is_movie(path.name)
+            changed, stat = manifest.changed(path)
+            if not changed:
+                trace.count("sources unchanged")
+                continue
+            stats[path] = stat
+
+            md5 = hashlib.md5(str(path).encode()).hexdigest()
+            outfile = os.path.join(config["thumbdir"], f"{md5}.{config['thumbnail_type']}")
+            if movie:
+                movies.append((path, outfile))
+                continue
+            yield path, outfile, height_ratio, pref_width, pref_height, grid
+
+    invalid = []
+    entries = {}
+    pending = []
+    errors = []
+    made = 0
+    fast_count = 0
+
+    def land(rows):
+        """Queue new palette rows, writing them out a batch at a time"""
+        entries.update(rows)
+        pending.extend(rows)
+        if len(pending) >= PALETTE_BATCH:
+            palette.append(pending)
+            pending.clear()
+            report("palette", len(palette))
+
+    with trace.span("thumbnail"):
+        results = make_thumbnails(jobs(), config.get("workers", 0))
+        for job, start_xy, end_xy, fast, row, digest, error in results:
+            path, outfile = job[:2]
+            stat = stats.pop(path)
+            report("thumb", made + len(errors) + 1, len(seen))
+            if error:
+                errors.append((path, error))
+                trace.item("failed", f"|{path.name[-26:]:26}|{'':12}|{'':10}|{'FAILED':26}|")
+                continue
+
+            status = outfile[-26:] if row else "TOO SHALLOW FOR PALETTE"
+            trace.item(
+                "thumbnails", f"|{path.name[-26:]:26}|{start_xy:^12}|{end_xy:^10}|{status:26}|"
+            )
+            trace.count("images decoded")
+            trace.count("bytes read", stat.st_size)
+            if trace.enabled():
+                trace.count("bytes written", os.path.getsize(outfile))
+            invalid.extend(thumb for thumb in manifest.thumbs(path) if thumb != outfile)
+            if row:
+                land([(outfile, row)])
+            else:
+                invalid.append(outfile)
+            manifest.record(path, stat, [outfile], [digest if row else None])
+            made += 1
+            fast_count += fast
+
+    # Movies are streamed frame by frame after the still images
+    with trace.span("frames"):
+        sampling = (frame_step, config.get("frame_scene", 0), config.get("frame_dedupe", 0))
+        for path, outfile in movies:
+            stat = stats.pop(path)
+            frames = []
+            try:
+                for index, thumb, row, digest in frame_thumbnails(
+                    path, outfile, height_ratio, pref_width, pref_height, grid, sampling
+                ):
+                    status = thumb[-26:] if row else "TOO SHALLOW FOR PALETTE"
+                    label = f"{path.name[-18:]} #{index}"
+                    end_xy = f"{pref_width}x{pref_height}"
+                    trace.item("frames", f"|{label[-26:]:26}|{'':12}|{end_xy:^10}|{status:26}|")
+                    frames.append((thumb, row, digest))
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                errors.append((path, f"{type(err).__name__}: {err}"))
+                trace.item("failed", f"|{path.name[-26:]:26}|{'':12}|{'':10}|{'FAILED':26}|")
+                for thumb, _, _ in frames:
+                    if thumb not in manifest.thumbs(path):
+                        os.remove(thumb)
+                continue
+
+            thumbs = [thumb for thumb, _, _ in frames]
+            invalid.extend(thumb for thumb in manifest.thumbs(path) if thumb not in thumbs)
+            invalid.extend(thumb for thumb, row, _ in frames if not row)
+            land([(thumb, row) for thumb, row, _ in frames if row])
+            digests = [digest if row else None for _, row, digest in frames]
+            manifest.record(path, stat, thumbs, digests)
+            made += len(thumbs)
+            report("thumb", made + len(errors), len(seen))
+
+    if not trace.quiet():
+        print(
+            "\\-----------------------------------------------------------------------------/\n"
+        )
+
+    orphans = manifest.purge(seen)
+
+    # Only one thumbnail of each cluster of near-duplicates goes in the palette
+    with trace.span("dedupe"):
+        distance = config.get("dedupe_distance", 0)
+        clusters = cluster(manifest.hashes(), distance, manifest.clusters(distance))
+        dropped = [thumb for members in clusters.values() for thumb, _ in members[1:]]
+        if distance:
+            manifest.record_clusters(clusters, distance)
+            listing = config.get("dedupe_report", "data/duplicates.txt")
+            collapsed = write_report(clusters, manifest.sources(), listing)
+            print(f"{collapsed} near-duplicate thumbnails left out of the palette, see {listing}")
+
+    # Kept thumbnails with no palette entry yet, such as a new representative, are re-read
+    with trace.span("palette"):
+        missing = [thumb for thumb in clusters if thumb not in palette and thumb not in entries]
+        for thumb, row, _ in analyze_images(missing, config.get("workers", 0), grid):
+            if row:
+                pending.append((thumb, row))
+
+        # The manifest goes last, so an interrupted run redoes anything not yet in the palette
+        palette.remove(invalid + orphans + dropped)
+        palette.append([(thumb, row) for thumb, row in pending if thumb in clusters])
+        report("palette", len(palette), len(palette))
+        manifest.save()
+
+    print(f"{len(manifest)} sources cached: {made} thumbnails made, {len(orphans)} orphans removed")
+    print(f"{len(palette)} items in the palette")
+    print(f"{fast_count} of {made} thumbnails were decoded at reduced size")
+
+    if errors:
+        print(f"{len(errors)} images could not be thumbnailed:")
+        for path, error in errors:
+            print(f"  {path} : {error}")
+    return palette
@@ -0,0 +1,117 @@
+""" Montage library: precomputed perceptual (CIELAB) color lookup table
+
+The RGB cube is cut into 2^bits buckets per side.  For the center of every
+bucket, the palette colors within ``distance`` (CIE76 delta E) of its nearest
+match are listed once, so matching a tile is a single array index plus a
+random pick from its bucket.  Tables are cached next to the palette, keyed
+by palette version, bucket size and distance.
+"""
+
+import os
+
+import numpy as np
+
+from lib.matcher import ColorMatcher
+
+# D65 reference white
+WHITE = np.array([0.95047, 1.0, 1.08883])
+
+SRGB_TO_XYZ = np.array(
+    [
+        [0.4124564, 0.3575761, 0.1804375],
+        [0.2126729, 0.7151522, 0.0721750],
+        [0.0193339, 0.1191920, 0.9503041],
+    ]
+)
+
+
+def rgb_to_lab(rgb):
+    """ Convert (..., 3) 8-bit sRGB colors to CIELAB """
+    srgb = np.asarray(rgb, dtype=np.float64) / 255
+    linear = np.where(srgb > 0.04045, ((srgb + 0.055) / 1.055) ** 2.4, srgb / 12.92)
+    xyz = linear @ SRGB_TO_XYZ.T / WHITE
+
+    f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    return np.stack(
+        [116 * f[..., 1] - 16, 500 * (f[..., 0] - f[..., 1]), 200 * (f[..., 1] - f[..., 2])],
+        axis=-1,
+    )
+
+
+class ColorLUT:  # pylint: disable=too-many-instance-attributes
+    """ Bucketed table of perceptually close palette entries for every RGB color """
+
+    def __init__(self, palette, distance, bits=5, max_candidates=256):
+        self.palette = palette
+        self.distance = distance
+        self.bits = bits
+        self.max_candidates = max_candidates
+        self.path = f"{palette.path}.lut-{bits}-{distance}.npz"
+        self.lab = rgb_to_lab(palette.colors)
+        self.offsets = None
+        self.candidates = None
+
+    def load(self):
+        """ Read the cached table for this palette version, building it if needed """
+        if os.path.exists(self.path):
+            with np.load(self.path) as cached:
+                if str(cached["version"]) == self.palette.version:
+                    self.offsets = cached["offsets"]
+                    self.candidates = cached["candidates"]
+                    return self
+
+        self.build()
+        with open(f"{self.path}.tmp", "wb") as f:
+            np.savez(
+                f,
+                version=self.palette.version,
+                offsets=self.offsets,
+                candidates=self.candidates,
+            )
+        os.replace(f"{self.path}.tmp", self.path)
+        return self
+
+    def build(self):
+        """ List the acceptable palette entries for the center of every bucket """
+        side = 1 << self.bits
+        print(f"Building {side}^3 Lab lookup table over {len(self.palette)} colors")
+
+        axis = (np.arange(side) + 0.5) * (256 / side)
+        centers = np.stack(np.meshgrid(axis, axis, axis, indexing="ij"), axis=-1).reshape(-1, 3)
+
+        rng = np.random.default_rng(0)
+        lists = [None] * len(centers)
+        matcher = ColorMatcher(self.lab, cell_size=max(self.distance, 4))
+        for index, rows, dist in matcher.neighbourhoods(
+            rgb_to_lab(centers), lambda dist: dist.min(axis=1) + self.distance
+        ):
+            band = dist <= dist.min(axis=1, keepdims=True) + self.distance
+            for bucket, keep in zip(index, band):
+                found = rows[keep]
+                if len(found) > self.max_candidates:
+                    found = rng.choice(found, self.max_candidates, replace=False)
+                lists[bucket] = found
+
+        counts = np.array([len(found) for found in lists])
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.candidates = np.concatenate(lists).astype(np.int32)
+
+    def match(self, targets, rng=None):
+        """ Pick a palette row for every target RGB color from its bucket
+
+        Returns the chosen rows and their delta E from the target.
+        """
+        rng = rng or np.random.default_rng()
+        targets = np.array(targets, dtype=np.int64, ndmin=2)
+
+        shift = 8 - self.bits
+        cells = targets >> shift
+        bucket = (cells[:, 0] << (2 * self.bits)) | (cells[:, 1] << self.bits) | cells[:, 2]
+
+        start = self.offsets[bucket]
+        count = self.offsets[bucket + 1] - start
+        pick = np.minimum((rng.random(len(targets)) * count).astype(np.int64), count - 1)
+        chosen = self.candidates[start + pick].astype(np.intp)
+
+        delta = np.linalg.norm(self.lab[chosen] - rgb_to_lab(targets), axis=1)
+        return chosen, delta
@@ -0,0 +1,153 @@
+""" Montage library: manifest of cached thumbnails and the sources they came from
+
+The manifest lives in the thumbnail directory and records, per source path,
+its size and mtime (and optionally a content hash) along with the thumbnails
+made from it, their difference hashes and the near-duplicate cluster each
+was last put in.  Re-runs use it to only touch new or changed sources, to
+find thumbnails whose source has gone away, and to only cluster thumbnails
+that are new or changed.
+"""
+
+import hashlib
+import json
+import os
+
+MANIFEST = "manifest.json"
+
+
+class ThumbManifest:
+    """ Incremental record of which thumbnails are current """
+
+    def __init__(self, thumbdir, settings, use_hash=False):
+        self.path = os.path.join(thumbdir, MANIFEST)
+        self.settings = settings
+        self.use_hash = use_hash
+        self.entries = {}
+        self.stale = False
+        self.radius = 0
+
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+            self.entries = data.get("files", {})
+            self.stale = data.get("settings") != settings
+            self.radius = data.get("dedupe_distance", 0)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def changed(self, path):
+        """ Check if the source path needs (re)thumbnailing; returns (changed, stat) """
+        stat = os.stat(path)
+        entry = self.entries.get(str(path))
+        if entry is None or self.stale or "hashes" not in entry:
+            return True, stat
+        if not all(os.path.exists(thumb) for thumb in entry["thumbs"]):
+            return True, stat
+        if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+            return False, stat
+        if self.use_hash and entry.get("hash") == content_hash(path):
+            entry["size"] = stat.st_size
+            entry["mtime"] = stat.st_mtime_ns
+            return False, stat
+        return True, stat
+
+    def thumbs(self, path):
+        """ Thumbnails previously made from the source path """
+        entry = self.entries.get(str(path))
+        return entry["thumbs"] if entry else []
+
+    def hashes(self):
+        """ Difference hash of every thumbnail that belongs in the palette """
+        return {
+            thumb: int(digest, 16)
+            for entry in self.entries.values()
+            for thumb, digest in zip(entry["thumbs"], entry.get("hashes", []))
+            if digest is not None
+        }
+
+    def clusters(self, radius):
+        """ {thumbnail: (representative, distance)} from the last clustering at this radius
+
+        Thumbnails made since, including remade ones, are left out.
+        """
+        if not radius or radius != self.radius:
+            return {}
+        return {
+            thumb: tuple(member)
+            for entry in self.entries.values()
+            for thumb, member in zip(entry["thumbs"], entry.get("clusters", []))
+            if member is not None
+        }
+
+    def duplicates(self):
+        """ Thumbnails the last clustering left out of the palette as near-duplicates """
+        return {
+            thumb
+            for thumb, (representative, _) in self.clusters(self.radius).items()
+            if thumb != representative
+        }
+
+    def record_clusters(self, clusters, radius):
+        """ Note the cluster every thumbnail was put in at this radius
+
+        Clusters are {representative: [(thumbnail, distance), ...]}.
+        """
+        members = {
+            thumb: [representative, dist]
+            for representative, listed in clusters.items()
+            for thumb, dist in listed
+        }
+        for entry in self.entries.values():
+            entry["clusters"] = [members.get(thumb) for thumb in entry["thumbs"]]
+        self.radius = radius
+
+    def sources(self):
+        """ Source path of every thumbnail """
+        return {thumb: path for path, entry in self.entries.items() for thumb in entry["thumbs"]}
+
+    def record(self, path, stat, thumbs, hashes):
+        """ Note that the source path has freshly made thumbnails, removing any it replaced
+
+        Hashes are the thumbnails' difference hashes, None for one kept out of the palette.
+        """
+        for thumb in self.thumbs(path):
+            if thumb not in thumbs and os.path.exists(thumb):
+                os.remove(thumb)
+
+        self.entries[str(path)] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "hash": content_hash(path) if self.use_hash else None,
+            "thumbs": list(thumbs),
+            "hashes": [None if digest is None else f"{digest:016x}" for digest in hashes],
+        }
+
+    def purge(self, seen):
+        """ Forget sources not in seen, delete their thumbnails and return them """
+        orphans = []
+        for path in [path for path in self.entries if path not in seen]:
+            for thumb in self.entries.pop(path)["thumbs"]:
+                if os.path.exists(thumb):
+                    os.remove(thumb)
+                orphans.append(thumb)
+        return orphans
+
+    def save(self):
+        """ Write the manifest back out """
+        with open(f"{self.path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(
+                {"settings": self.settings, "dedupe_distance": self.radius, "files": self.entries},
+                f,
+            )
+        os.replace(f"{self.path}.tmp", self.path)
+        self.stale = False
+
+
+def content_hash(path):
+    """ MD5 of a file's contents """
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
@@ -0,0 +1,287 @@
+""" Montage library: indexed nearest-color matching over the palette """
+
+import numpy as np
+
+# Upper bound on the number of distances measured in one numpy call
+CHUNK_CELLS = 1 << 20
+
+# Palette colors per grid cell to aim for when picking cell edges
+CELL_FILL = 4
+
+# Most grid cells to allocate, however large the palette
+MAX_CELLS = 1 << 21
+
+# Palette colors per query block to aim for; targets in one block share a candidate set
+QUERY_ROWS = 128
+
+# Targets reaching this many times further than their block's median gather alone
+OUTLIER = 4
+
+# Random draws per target, per round, and rounds, when sampling a tolerance band
+SAMPLES = 16
+ROUNDS = 4
+
+# Slack on gathering distances, for rounding in how distances are measured
+MARGIN = 1e-3
+
+
+class ColorMatcher:  # pylint: disable=too-many-instance-attributes
+    """ Adaptive grid index over palette colors for batched nearest-color lookups
+
+    Colors are turned onto their principal axes and bucketed into a grid
+    whose cell edges follow the quantiles of the colors along each axis,
+    with more cells along the axes they spread furthest on.  Cells so hold a
+    handful of colors each however the palette is spread, whether it fills
+    the color cube or, like a greyscale library, lies along one line of it.
+    A query only measures distances against the cells around it, so the
+    cost of a lookup follows how crowded its neighbourhood is rather than
+    the library size.  A ``cell_size`` gives evenly spaced edges instead.
+    """
+
+    def __init__(self, colors, cell_size=None):
+        self.colors = np.array(colors, dtype=np.float64, ndmin=2)
+        if self.colors.size == 0:
+            raise ValueError("Cannot match against an empty palette")
+
+        # Turning onto the principal axes keeps distances, and lines a skewed palette up
+        self.mean = self.colors.mean(axis=0)
+        centered = self.colors - self.mean
+        variance, axes = np.linalg.eigh(centered.T @ centered)
+        self.axes = axes[:, ::-1]
+        self.points = centered @ self.axes
+        self.low = self.points.min(axis=0)
+        self.high = self.points.max(axis=0)
+        self.norms = np.einsum("ij,ij->i", self.points, self.points)
+
+        if cell_size is None:
+            self.edges = quantile_edges(self.points, np.sqrt(np.maximum(variance[::-1], 0)))
+        else:
+            self.edges = [
+                np.arange(axis.min() + cell_size, axis.max(), cell_size) for axis in self.points.T
+            ]
+        self.shape = np.array([len(edges) + 1 for edges in self.edges])
+
+        cells = self.cells(self.points)
+        ids = np.ravel_multi_index(tuple(cells.T), tuple(self.shape))
+        self.order = np.argsort(ids, kind="stable")
+        self.starts = np.searchsorted(ids[self.order], np.arange(np.prod(self.shape) + 1))
+
+        # Query blocks span about QUERY_ROWS colors, going by how full the used cells are
+        fill = len(self.colors) / np.count_nonzero(np.diff(self.starts))
+        spread = max(1, np.count_nonzero(self.shape > 1))
+        self.block = np.minimum(
+            max(1, int(round((QUERY_ROWS / fill) ** (1 / spread)))), self.shape
+        )
+
+    def __len__(self):
+        return len(self.colors)
+
+    def project(self, targets):
+        """ Targets turned onto the palette's principal axes """
+        return (targets - self.mean) @ self.axes
+
+    def cells(self, points):
+        """ Grid cell coordinates of the given projected points, clamped onto the grid """
+        return np.stack(
+            [
+                np.searchsorted(edges, axis, side="right")
+                for edges, axis in zip(self.edges, points.T)
+            ],
+            axis=-1,
+        )
+
+    def around(self, lo, hi):
+        """ Palette rows in the cells from lo to hi (inclusive), clamped onto the grid """
+        lo = np.maximum(lo, 0)
+        hi = np.minimum(hi, self.shape - 1)
+        axes = [np.arange(lo[d], hi[d] + 1) for d in range(len(self.shape))]
+        ids = np.ravel_multi_index(np.meshgrid(*axes, indexing="ij"), tuple(self.shape)).ravel()
+
+        starts = self.starts[ids]
+        lens = self.starts[ids + 1] - starts
+        offsets = np.repeat(starts - np.cumsum(lens) + lens, lens) + np.arange(lens.sum())
+        return self.order[offsets]
+
+    def distances(self, points, rows):
+        """ Euclidean distance from every projected point to every given palette row """
+        square = np.einsum("ij,ij->i", points, points)[:, None] + self.norms[rows][None, :]
+        square -= 2 * points @ self.points[rows].T
+        return np.sqrt(np.maximum(square, 0))
+
+    def blocks(self, points):
+        """ Yield (point indices, lo, hi) for the points in each query block
+
+        lo and hi are the block's corner cells, inclusive.
+        """
+        keys = self.cells(points) // self.block
+        ids = np.ravel_multi_index(tuple(keys.T), tuple(-(-self.shape // self.block)))
+        order = np.argsort(ids, kind="stable")
+        _, first = np.unique(ids[order], return_index=True)
+
+        for group in np.split(order, first[1:]):
+            lo = keys[group[0]] * self.block
+            yield group, lo, lo + self.block - 1
+
+    def neighbourhoods(self, targets, reach, minimum=1):
+        """ Yield (target indices, palette rows, distances) covering each target
+
+        Targets are grouped into blocks of grid cells so every group shares
+        one gathered candidate set.  At least ``minimum`` palette rows are
+        gathered around each block first, then ``reach(distances)`` maps the
+        distances to those rows to how far out each target's candidates must
+        be collected.
+        """
+        points = self.project(targets)
+        for group, lo, hi in self.blocks(points):
+            radius = 0
+            rows = self.around(lo, hi)
+            while len(rows) < minimum:
+                radius = max(1, 2 * radius)
+                rows = self.around(lo - radius, hi + radius)
+
+            step = max(1, CHUNK_CELLS // len(rows))
+            needed = MARGIN + np.concatenate(
+                [
+                    reach(self.distances(points[group[i : i + step]], rows))
+                    for i in range(0, len(group), step)
+                ]
+            )
+
+            # A few far-flung targets would stretch the whole block's box, so they gather alone
+            wide = needed > OUTLIER * np.median(needed)
+            yield from self.within(points, group[~wide], needed[~wide])
+            for i in np.flatnonzero(wide):
+                yield from self.within(points, group[i : i + 1], needed[i : i + 1])
+
+    def within(self, points, index, needed):
+        """ Yield (indices, palette rows, distances) for the indexed points
+
+        The rows gathered include every palette row within each point's
+        needed distance of it.
+        """
+        rows = self.around(*self.box(points[index], needed))
+        step = max(1, CHUNK_CELLS // len(rows))
+        for i in range(0, len(index), step):
+            chunk = index[i : i + step]
+            yield chunk, rows, self.distances(points[chunk], rows)
+
+    def box(self, points, distance):
+        """ Corner cells of the box holding every point grown by its distance
+
+        A point lying off the palette's extent along some axes has that much
+        less of its distance left to reach along the others.
+        """
+        distance = np.asarray(distance)[:, None]
+        outside = np.maximum(self.low - points, 0) + np.maximum(points - self.high, 0)
+        outside *= outside
+        reach = np.sqrt(np.maximum(distance**2 - (outside.sum(axis=1, keepdims=True) - outside), 0))
+        lo = self.cells((points - reach).min(axis=0))
+        return lo, self.cells((points + reach).max(axis=0))
+
+    def match(self, targets, color_distance, rng=None):
+        """ Pick a palette row for every target color
+
+        Every palette color within ``color_distance`` of a target's nearest
+        match is acceptable, and one of those is chosen at random.
+        Returns the chosen rows and their distances.
+        """
+        rng = rng or np.random.default_rng()
+        targets = np.array(targets, dtype=np.float64, ndmin=2)
+        points = self.project(targets)
+
+        chosen = np.empty(len(targets), dtype=np.intp)
+        delta = np.empty(len(targets), dtype=np.float64)
+        for index, _, dist in self.neighbourhoods(targets, lambda dist: dist.min(axis=1)):
+            limit = dist.min(axis=1) + color_distance + MARGIN
+            rows = self.around(*self.box(points[index], limit))
+            chosen[index], delta[index] = self.pick(points[index], rows, limit, rng)
+        return chosen, delta
+
+    def pick(self, points, rows, limit, rng):
+        """ Choose, uniformly at random, one of the rows within limit of every point
+
+        Random draws soon land in the band when it is a fair share of the
+        rows; points still without a match after a few rounds of them
+        measure every row and pick from the band directly.
+        """
+        if len(rows) > ROUNDS * SAMPLES:
+            chosen, delta = self.draw(points, rows, limit, rng)
+        else:
+            chosen = np.full(len(points), -1, dtype=np.intp)
+            delta = np.empty(len(points), dtype=np.float64)
+
+        pending = np.flatnonzero(chosen < 0)
+        step = max(1, CHUNK_CELLS // len(rows))
+        for i in range(0, len(pending), step):
+            part = pending[i : i + step]
+            dist = self.distances(points[part], rows)
+            # Random keys pick uniformly among the rows inside the band
+            pick = np.where(dist <= limit[part][:, None], rng.random(dist.shape), -1).argmax(axis=1)
+            chosen[part] = rows[pick]
+            delta[part] = dist[np.arange(len(pick)), pick]
+        return chosen, delta
+
+    def draw(self, points, rows, limit, rng):
+        """ Draw rows at random for each point until one is within its limit
+
+        Gives up after ROUNDS rounds of SAMPLES draws, leaving -1 as the
+        choice for points that found nothing.
+        """
+        chosen = np.full(len(points), -1, dtype=np.intp)
+        delta = np.empty(len(points), dtype=np.float64)
+
+        pending = np.arange(len(points))
+        for _ in range(ROUNDS):
+            picks = rows[rng.integers(0, len(rows), size=(len(pending), SAMPLES))]
+            offset = points[pending][:, None, :] - self.points[picks]
+            sample = np.sqrt(np.einsum("ijk,ijk->ij", offset, offset))
+            inside = sample <= limit[pending][:, None]
+
+            hit = inside.any(axis=1)
+            first = inside.argmax(axis=1)[hit]
+            chosen[pending[hit]] = picks[hit, first]
+            delta[pending[hit]] = sample[hit, first]
+            pending = pending[~hit]
+            if not pending.size:
+                break
+        return chosen, delta
+
+    def nearest(self, targets, k):
+        """ The k nearest palette rows to every target, closest first
+
+        Returns (rows, distances), both of shape (targets, k).
+        """
+        k = min(k, len(self))
+        targets = np.array(targets, dtype=np.float64, ndmin=2)
+
+        chosen = np.empty((len(targets), k), dtype=np.intp)
+        delta = np.empty((len(targets), k), dtype=np.float64)
+        for index, rows, dist in self.neighbourhoods(
+            targets, lambda dist: np.partition(dist, k - 1, axis=1)[:, k - 1], minimum=k
+        ):
+            best = np.argpartition(dist, k - 1, axis=1)[:, :k]
+            best_dist = np.take_along_axis(dist, best, axis=1)
+            ranked = np.argsort(best_dist, axis=1, kind="stable")
+
+            chosen[index] = rows[np.take_along_axis(best, ranked, axis=1)]
+            delta[index] = np.take_along_axis(best_dist, ranked, axis=1)
+        return chosen, delta
+
+
+def quantile_edges(points, spread):
+    """ Interior cell edges along each axis, at quantiles of the points along it
+
+    Cells are handed out a doubling at a time to whichever axis has the
+    widest cells, until there are about CELL_FILL points per cell.
+    """
+    wanted = min(MAX_CELLS, max(1, len(points) // CELL_FILL))
+    counts = np.ones(len(spread), dtype=np.intp)
+    while np.prod(counts) * 2 <= wanted:
+        widest = np.argmax(spread / counts)
+        if spread[widest] <= 0:
+            break
+        counts[widest] *= 2
+    return [
+        np.unique(np.quantile(axis, np.arange(1, count) / count))
+        for axis, count in zip(points.T, counts)
+    ]
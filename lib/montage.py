@@ -1,18 +1,22 @@
 """ Montage library: common utilities and functions """
 
-import random
-
-from math import ceil
+import os
 
 import numpy as np
 
-from wand.color import Color
-from wand.drawing import Drawing
 from wand.image import Image
 
+from lib.assign import assign_tiles
+from lib.matcher import ColorMatcher
+from lib import trace
+
+
+@trace.span("big pixels")
+def calculate_big_pixels(img, upscale, grid=0):
+    """ Given an size, and "big pixel" size, divide up locations for big pixels.
 
-def calculate_big_pixels(img, upscale):
-    """ Given an size, and "big pixel" size, divide up locations for big pixels. """
+    With a grid set, each big pixel also carries its grid signature after its color.
+    """
 
     bigpixels = []
     start_x = 0
@@ -25,88 +29,164 @@ def calculate_big_pixels(img, upscale):
             fin_y = start_y + img['pixel_height']
             fin_y = min(fin_y, img['out_height'])
 
-            color_data = color_check(img['ref'], start_x, start_y, fin_x, fin_y, upscale)
-            bigpixels.append([start_x, start_y, fin_x, fin_y, color_data])
+            bigpixels.append([start_x, start_y, fin_x, fin_y])
 
             start_y = fin_y
         start_x = fin_x
+
+    pixels = image_pixels(img['ref'])
+    colors = color_check(pixels, bigpixels, upscale)
+    for bp, color_data in zip(bigpixels, colors.tolist()):
+        bp.append(color_data)
+    if grid:
+        signatures = signature_check(pixels, bigpixels, upscale, grid)
+        for bp, signature in zip(bigpixels, signatures.tolist()):
+            bp.append(signature)
     return bigpixels
 
 
-def calculate_locations(cache, bigpixels, color_distance):
-    """ Given a set of big-pixels and their colors, find the best image to fill those locations """
+@trace.span("locations")
+def calculate_locations(  # pylint: disable=R0913,R0914
+    cache, bigpixels, color_distance, lut=None, max_uses=0, min_spacing=0, signatures=None,
+    matcher=None, rng=None,
+):
+    """ Given a set of big-pixels and their colors, find the best image to fill those locations
+
+    Colors are matched by RGB distance, through the Lab lookup table, or by grid signature
+    through the signature index, whichever is given.  With max_uses or min_spacing set,
+    tiles are instead assigned jointly under those limits, by average color, warning that
+    the table or index goes unused, and each takes its best image rather than a random one
+    within color_distance.  A prebuilt ColorMatcher over the palette colors may be passed
+    in to save building one, and a seeded numpy Generator as rng makes the random choices
+    between close colors repeatable.
+    """
     print('Calculating "big pixel" locations')
+    targets = [bp[4] for bp in bigpixels]
+    if matcher is None and (max_uses or min_spacing or (signatures is None and lut is None)):
+        matcher = ColorMatcher(cache.colors)
+    if max_uses or min_spacing:
+        ignored = [
+            name
+            for name, used in (
+                ("match_mode: lab", lut is not None),
+                ("signature_grid", signatures is not None),
+            )
+            if used
+        ]
+        if ignored:
+            print(
+                "Warning: with max_uses or min_spacing set, tiles are assigned by average "
+                f"RGB color alone, so {', '.join(ignored)} will be ignored"
+            )
+        columns = np.unique([bp[0] for bp in bigpixels], return_inverse=True)[1]
+        rows = np.unique([bp[1] for bp in bigpixels], return_inverse=True)[1]
+        chosen, delta, baseline = assign_tiles(
+            matcher, targets, np.stack([columns, rows], axis=1),
+            max_uses, min_spacing, rng,
+        )
+        error = delta.sum()
+        best = baseline.sum()
+        print(f"Total color error {error:.0f} against {best:.0f} unconstrained", end="")
+        print(f" ({100 * (error / max(best, 1) - 1):+.1f}%)")
+    elif signatures is not None:
+        chosen, delta = signatures.match([bp[5] for bp in bigpixels], color_distance, rng)
+    elif lut is not None:
+        chosen, delta = lut.match(targets, rng)
+    else:
+        chosen, delta = matcher.match(targets, color_distance, rng)
+
+    trace.items(
+        "tiles matched",
+        (
+            f"{bp[0]},{bp[1]} : {bp[4]} -> {dist:.2f} -> {cache.colors[row].tolist()} : "
+            f"{cache.paths[row]}"
+            for bp, row, dist in zip(bigpixels, chosen, delta)
+        ),
+        len(bigpixels),
+    )
+
     locations = {}
-    for bp in bigpixels:
-        [file, delta] = find_closest(cache, *bp[4], color_distance)
-        cache_color = cache.get(file)
-        print(f"{bp[0]},{bp[1]} : {bp[4]} -> {delta:.2f} -> {cache_color} : {file}")
+    for bp, row in zip(bigpixels, chosen):
+        file = cache.paths[row]
         if file not in locations:
             locations[file] = []
         locations[file].append([bp[0], bp[1]])
     return locations
 
 
-def color_check(img, start_x, start_y, fin_x, fin_y, upscale):  # pylint: disable=R0913,R0914
-    """ Given an image handle, and bounds, calculate the average color """
+def color_check(pixels, bounds, upscale):
+    """ Given decoded goal pixels, and output-space bounds, calculate the average colors
+
+    Each (start_x, start_y, fin_x, fin_y) box is scaled down to the goal image and
+    summed from one summed-area table, so ragged edge boxes cost the same as the rest.
+    """
+    return box_averages(summed_area(pixels), *goal_boxes(pixels, bounds, upscale))
 
-    start_x = int(start_x/upscale)
-    start_y = int(start_y/upscale)
-    fin_x = ceil(fin_x/upscale)
-    fin_y = ceil(fin_y/upscale)
 
-    count = 0
-    count_red = 0
-    count_green = 0
-    count_blue = 0
+def signature_check(pixels, bounds, upscale, grid):
+    """ Given decoded goal pixels, and output-space bounds, calculate grid signatures
 
-    with img[start_x:fin_x, start_y:fin_y] as cropped:
-        blob = cropped.make_blob(format='RGB')
-        for cursor in range(0, cropped.width * cropped.height * 3, 3):
-            count_red += blob[cursor]
-            count_green += blob[cursor + 1]
-            count_blue += blob[cursor + 2]
-            count += 1
+    Each box is cut into grid x grid cells, and a signature is the average
+    colors of those cells, row by row, flattened to 3 * grid^2 values.
+    """
+    cells = grid_boxes(*goal_boxes(pixels, bounds, upscale), grid)
+    averages = box_averages(summed_area(pixels), *(edge.ravel() for edge in cells))
+    return averages.reshape(len(cells[0]), -1)
 
-    av_r = int(count_red/count)
-    av_g = int(count_green/count)
-    av_b = int(count_blue/count)
 
-    return [av_r, av_g, av_b]
+def grid_signature(pixels, grid):
+    """ The grid x grid signature of a whole (height, width, 3) image """
+    height, width = pixels.shape[:2]
+    cells = grid_boxes(*np.array([[0], [0], [width], [height]]), grid)
+    return box_averages(summed_area(pixels), *(edge.ravel() for edge in cells)).ravel()
 
 
-def draw_pixelated(img, bigpixels, out_file):
-    """ Draw a flat-color "pixelated" version of the output for error checking. """
-    print("Drawing pixelated file.")
-    draw = Drawing()
-    for bp in bigpixels:
-        draw.fill_color = Color(f"rgb({bp[4][0]}, {bp[4][1]}, {bp[4][2]})")
-        draw.polygon([(bp[0],bp[1]),(bp[0],bp[3]),(bp[2],bp[3]),(bp[2],bp[1])])
+def goal_boxes(pixels, bounds, upscale):
+    """ Scale output-space boxes down to goal pixels, as start_x, start_y, fin_x, fin_y arrays """
+    boxes = np.array([box[:4] for box in bounds], dtype=np.float64).reshape(-1, 4)
+    start_x, start_y = np.floor(boxes[:, :2] / upscale).astype(np.intp).T
+    fin_x = np.minimum(np.ceil(boxes[:, 2] / upscale).astype(np.intp), pixels.shape[1])
+    fin_y = np.minimum(np.ceil(boxes[:, 3] / upscale).astype(np.intp), pixels.shape[0])
+    return start_x, start_y, fin_x, fin_y
 
-    print(f"Writing pixelated output for reference: {out_file}")
-    with Image(width=img['out_width'], height=img['out_height']) as pix:
-        draw.draw(pix)
-        pix.save(filename=out_file)
 
+def grid_boxes(start_x, start_y, fin_x, fin_y, grid):
+    """ Cut every box into grid x grid cells, returned as four (boxes, grid^2) arrays
 
-def find_closest(cache, r, g, b, color_distance):
-    """ Find nearby RGB matches in the cache using Euclidian distance """
-    dist = 350  # 8-bit color reduced
-    best = []
-    point1 = np.array([r, g, b])
+    Boxes narrower than the grid reuse pixels, so no cell is ever empty.
+    """
+    steps = np.arange(grid + 1)
 
-    for file in cache.getall():
-        point2 = np.array(cache.get(file))
-        tdist = np.linalg.norm(point1 - point2)
+    def split(start, fin):
+        edges = start[:, None] + (fin - start)[:, None] * steps // grid
+        lo = edges[:, :-1]
+        return lo, np.maximum(edges[:, 1:], lo + 1)
 
-        if (tdist + color_distance) < dist:  # Collect files of increasing precision
-            best = [ file ]
-            dist = tdist
-        elif dist == tdist:
-            best.append(file)
+    lo_x, hi_x = split(start_x, fin_x)
+    lo_y, hi_y = split(start_y, fin_y)
+    shape = (len(start_x), grid, grid)
+    return (
+        np.broadcast_to(lo_x[:, None, :], shape).reshape(len(start_x), -1),
+        np.broadcast_to(lo_y[:, :, None], shape).reshape(len(start_x), -1),
+        np.broadcast_to(hi_x[:, None, :], shape).reshape(len(start_x), -1),
+        np.broadcast_to(hi_y[:, :, None], shape).reshape(len(start_x), -1),
+    )
+
+
+def summed_area(pixels):
+    """ Summed-area table of a (height, width, 3) image, padded with a zero row and column """
+    table = np.zeros((pixels.shape[0] + 1, pixels.shape[1] + 1, 3), dtype=np.int64)
+    np.cumsum(np.cumsum(pixels, axis=0, dtype=np.int64), axis=1, out=table[1:, 1:])
+    return table
+
+
+def box_averages(table, start_x, start_y, fin_x, fin_y):
+    """ Average colors of the given pixel boxes, from a summed-area table """
+    sums = table[fin_y, fin_x] - table[start_y, fin_x]
+    sums += table[start_y, start_x] - table[fin_y, start_x]
+    count = ((fin_x - start_x) * (fin_y - start_y))[:, None]
+    return sums // count
 
-    choice = random.choice(best)
-    return [ choice, dist ]
 
 def is_image(name):
     """ Given an image name, check the extension to see if we consider it an image. """
@@ -116,39 +196,116 @@ def is_image(name):
     return False
 
 
-def makethumb(path, outfile, height_ratio, pref_width, pref_height):
-    """ Given a display name, infile and outfile designation: Create the smaller image """
-    with Image(filename=path) as img:
-        width = img.width
-        height = img.height
+def dhash(img, size=8):
+    """ Difference hash of a Wand image, as a size * size bit integer
+
+    The image is shrunk to (size + 1) x size and each bit says whether a pixel
+    is brighter than its left neighbour, so near-identical images differ in
+    only a few bits.
+    """
+    with img.clone() as small:
+        small.resize(size + 1, size)
+        grey = image_pixels(small) @ np.array([0.299, 0.587, 0.114])
+    bits = np.packbits(grey[:, 1:] > grey[:, :-1])
+    return int.from_bytes(bits.tobytes(), 'big')
+
 
-        xy = f"{width}x{height}"
-        print(f"|{path.name[-26:]:26}|{xy:^12}|", end='')
+def hamming(first, second):
+    """ Number of bits two hashes differ in """
+    return (first ^ second).bit_count()
 
-        current_ratio = height / width
 
-        new_height = new_width = None
-        if current_ratio > height_ratio:  # tall and narrow
-            delta = pref_width / width
-            new_height = int(height * delta)
-            new_width = pref_width
-        elif height_ratio > current_ratio:  # Fat and wide
-            delta = pref_height / height
-            new_height = pref_height
-            new_width = int(width * delta)
-        else:  # perfect size
-            new_height = pref_height
-            new_width = pref_width
+def image_pixels(img):
+    """ Decode a Wand image into a (height, width, 3) array of 8-bit RGB """
+    blob = img.make_blob(format='RGB')
+    pixels = np.frombuffer(blob, dtype=np.uint8, count=img.width * img.height * 3)
+    return pixels.reshape(img.height, img.width, 3)
+
+
+def palette_row(img, grid=0):
+    """ Given a decoded Wand image, return its palette row and maxima
+
+    The row is the average [r, g, b], followed by the grid signature when a
+    grid is given.  It is None when the image's depth is too shallow.
+    """
+    maxima = img.maxima
+    if maxima < 65535:
+        return None, maxima
+
+    pixels = image_pixels(img)
+    flat = pixels.reshape(-1, 3)
+    row = flat.sum(axis=0, dtype='uint64') // len(flat)
+    if grid:
+        row = np.concatenate([row, grid_signature(pixels, grid)])
+    return row.tolist(), maxima
+
+
+def makethumb(  # pylint: disable=R0913
+    path, outfile, height_ratio, pref_width, pref_height, grid=0
+):
+    """ Given an infile and outfile designation: Create the smaller image
+
+    Returns the starting and ending sizes as "WxH" strings, whether the
+    source was decoded at less than its full size, and the thumbnail's
+    palette row (see palette_row) and difference hash, taken from the pixels
+    already in memory.
+    """
+    with Image() as probe:
+        probe.ping(filename=str(path))
+        width = probe.width
+        height = probe.height
+
+    new_width, new_height = thumb_size(width, height, height_ratio, pref_width, pref_height)
+
+    with Image() as img:
+        read_reduced(img, path, new_width, new_height)
+        # Only a decoder that actually scaled down counts, whatever it was asked for
+        fast = img.width < width
 
         img.resize(new_width, new_height)
         img.crop(height=pref_height, width=pref_width, gravity='center')
 
-        width = img.width
-        height = img.height
-
-        xy = f"{width}x{height}"
-        print(f"{xy:^10}|", end='')
+        row, _ = palette_row(img, grid)
+        digest = dhash(img)
 
         img.save(filename=outfile)
-
-        print(f"{outfile[-26:]:26}|")
+        return f"{width}x{height}", f"{img.width}x{img.height}", fast, row, digest
+
+
+def thumb_size(width, height, height_ratio, pref_width, pref_height):
+    """ Given a source size, the size to resize to before cropping to the thumbnail """
+    current_ratio = height / width
+
+    new_height = new_width = None
+    if current_ratio > height_ratio:  # tall and narrow
+        delta = pref_width / width
+        new_height = int(height * delta)
+        new_width = pref_width
+    elif height_ratio > current_ratio:  # Fat and wide
+        delta = pref_height / height
+        new_height = pref_height
+        new_width = int(width * delta)
+    else:  # perfect size
+        new_height = pref_height
+        new_width = pref_width
+    return new_width, new_height
+
+
+def read_reduced(img, path, width, height):
+    """ Read path into img, asking the decoder for no more than we need
+
+    JPEGs are DCT-scaled down to no less than twice the wanted size, and
+    layered or animated formats only have their first image read.  The
+    decoder is free to ignore the hint, so check img's size to see what it
+    did.
+    """
+    name = str(path)
+    ext = os.path.splitext(name)[1].lower()
+
+    if ext in ('.jpg', '.jpeg'):
+        img.options['jpeg:size'] = f"{width * 2}x{height * 2}"
+        img.read(filename=name)
+    elif ext in ('.gif', '.psd'):
+        img.read(filename=f"{name}[0]")
+    else:
+        img.read(filename=name)
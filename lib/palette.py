@@ -0,0 +1,30 @@
+""" Montage library: building the color palette from cached thumbnails """
+
+from functools import partial
+
+from wand.image import Image
+
+from lib.montage import palette_row
+from lib.parallel import parallel_map
+
+
+def average_color(path, grid=0):
+    """ Given an image path, return (path, [r, g, b, ...], maxima)
+
+    The average color is followed by the image's grid signature when a grid
+    is given, making up its palette row.  The row is None when the image is
+    rejected: either its depth is too shallow (maxima is reported) or it
+    could not be read (maxima is None).
+    """
+    try:
+        with Image(filename=path) as img:
+            row, maxima = palette_row(img, grid)
+    except (IndexError, ValueError):
+        return str(path), None, None
+
+    return str(path), row, maxima
+
+
+def analyze_images(paths, workers=0, grid=0):
+    """ Average the color of every image, in order, across a pool of worker processes """
+    return parallel_map(partial(average_color, grid=grid), paths, workers, chunksize=64)
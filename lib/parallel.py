@@ -0,0 +1,56 @@
+""" Montage library: process pool helpers """
+
+import os
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from lib import trace
+
+
+def worker_count(workers):
+    """ Resolve a configured worker count; zero (or less) means one per core """
+    if workers and workers > 0:
+        return workers
+    return os.cpu_count() or 1
+
+
+def parallel_map(func, items, workers=0, chunksize=16):
+    """ Like map(), but fanned out over a pool of processes
+
+    Results come back in input order, a chunk at a time.  Only a couple of
+    chunks per worker are in flight at once, so a huge input list is never
+    queued up in one go.  Work the workers count is added to this process's
+    trace as their chunks come back.
+    """
+    workers = worker_count(workers)
+    if workers == 1:
+        yield from map(func, items)
+        return
+
+    items = iter(items)
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        try:
+            for chunk in iter(lambda: list(islice(items, chunksize)), []):
+                pending.append(pool.submit(_run_chunk, func, chunk))
+                if len(pending) >= workers * 2:
+                    yield from _results(pending.popleft())
+            while pending:
+                yield from _results(pending.popleft())
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _run_chunk(func, chunk):
+    """ Run func over one chunk of items inside a worker process, with the work it counted """
+    return trace.collect(lambda: [func(item) for item in chunk])
+
+
+def _results(future):
+    """ The results of a finished chunk, once its counted work is added here """
+    results, counts = future.result()
+    trace.merge(counts)
+    return results
@@ -0,0 +1,119 @@
+""" Montage library: an in-process pipeline of stages with cached results
+
+A stage is a function of the config and the results of the stages it
+depends on.  Its result is cached under a hash of the config keys it reads
+and the keys of its inputs, so changing one setting only reruns the stages
+downstream of it.  Volatile stages, the ones that look at the outside world
+like crawling a directory, always run and are keyed by a hash of what they
+found instead.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+
+from lib import trace
+
+# Cached results kept per stage, least recently used dropped first
+KEEP = 8
+
+
+class Pipeline:
+    """ A DAG of named stages whose results are cached by what they depend on """
+
+    def __init__(self, config, cache_dir):
+        self.config = config
+        self.cache_dir = cache_dir
+        self.stages = {}
+        self.keys = {}
+        self.results = {}
+
+    def stage(self, name, inputs=(), keys=(), volatile=False, fresh=None):  # pylint: disable=R0913
+        """ Decorator registering func(config, *input results) as a stage
+
+        Keys are the config keys the stage reads.  A cached result is only
+        reused if ``fresh(result)`` (when given) says what it points at on
+        disk is still there.
+        """
+
+        def register(func):
+            self.stages[name] = (func, tuple(inputs), tuple(keys), volatile, fresh)
+            return func
+
+        return register
+
+    def run(self, name):
+        """ The result of a stage, running whatever upstream of it has changed """
+        if name in self.results:
+            return self.results[name]
+
+        func, inputs, keys, volatile, fresh = self.stages[name]
+        values = [self.run(upstream) for upstream in inputs]
+
+        if volatile:
+            with trace.span(f"pipeline {name}"):
+                result = func(self.config, *values)
+            key = digest(pickle.dumps(result))
+        else:
+            key = digest(
+                json.dumps(
+                    {
+                        "stage": name,
+                        "config": {k: self.config.get(k) for k in keys},
+                        "inputs": [self.keys[upstream] for upstream in inputs],
+                    },
+                    sort_keys=True,
+                    default=str,
+                ).encode("utf-8")
+            )
+            result = self.cached(name, key, fresh)
+            if result is None:
+                print(f"[{name}] running")
+                with trace.span(f"pipeline {name}"):
+                    result = func(self.config, *values)
+                self.store(name, key, result)
+            else:
+                print(f"[{name}] cached")
+
+        self.keys[name] = key
+        self.results[name] = result
+        return result
+
+    def path(self, name, key):
+        """ Where a stage's result for the given key is cached """
+        return os.path.join(self.cache_dir, f"{name}-{key}.pickle")
+
+    def cached(self, name, key, fresh=None):
+        """ A stage's cached result for the key, or None """
+        path = self.path(name, key)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            result = pickle.load(f)
+        if fresh is not None and not fresh(result):
+            return None
+        os.utime(path)
+        return result
+
+    def store(self, name, key, result):
+        """ Cache a stage's result, dropping its least recently used old ones """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.path(name, key)
+        with open(f"{path}.tmp", "wb") as f:
+            pickle.dump(result, f)
+        os.replace(f"{path}.tmp", path)
+
+        prefix = f"{name}-"
+        older = sorted(
+            (entry for entry in os.scandir(self.cache_dir) if entry.name.startswith(prefix)),
+            key=lambda entry: entry.stat().st_mtime_ns,
+            reverse=True,
+        )
+        for entry in older[KEEP:]:
+            os.remove(entry.path)
+
+
+def digest(data):
+    """ Short hex hash of some bytes """
+    return hashlib.sha256(data).hexdigest()[:16]
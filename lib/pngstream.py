@@ -0,0 +1,100 @@
+""" Montage library: PNG encoder that takes its rows a band at a time """
+
+import struct
+import zlib
+
+import numpy as np
+
+SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Compressed bytes per IDAT chunk, so the file doesn't depend on how rows were banded
+IDAT_SIZE = 1 << 16
+
+
+class PngWriter:
+    """ Write an 8-bit RGB PNG from successive bands of rows
+
+    Rows are Paeth filtered and deflated as they arrive, so only the band
+    being written (and the last row before it) is ever held in memory.
+    """
+
+    def __init__(self, filename, width, height, level=6):
+        self.width = width
+        self.height = height
+        self.rows = 0
+        self.prior = np.zeros((width, 3), dtype=np.uint8)
+        self.compressor = zlib.compressobj(level)
+        self.pending = bytearray()
+
+        self.file = open(filename, "wb")  # pylint: disable=consider-using-with
+        self.file.write(SIGNATURE)
+        self.chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def chunk(self, kind, data):
+        """ Write one length-prefixed, CRC-suffixed PNG chunk """
+        self.file.write(struct.pack(">I", len(data)))
+        self.file.write(kind)
+        self.file.write(data)
+        self.file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+    def write(self, rows):
+        """ Append a (rows, width, 3) uint8 band to the image """
+        rows = np.asarray(rows, dtype=np.uint8)
+        if rows.shape[1:] != (self.width, 3):
+            raise ValueError(f"Expected rows {self.width} pixels wide, got {rows.shape}")
+        if self.rows + len(rows) > self.height:
+            raise ValueError(f"Too many rows for a {self.height} pixel tall image")
+
+        above = np.concatenate([self.prior[None], rows[:-1]])
+        lines = np.empty((len(rows), 1 + self.width * 3), dtype=np.uint8)
+        lines[:, 0] = 4  # Paeth filter
+        lines[:, 1:] = paeth(rows, above).reshape(len(rows), -1)
+
+        self.pending += self.compressor.compress(lines.tobytes())
+        while len(self.pending) >= IDAT_SIZE:
+            self.chunk(b"IDAT", bytes(self.pending[:IDAT_SIZE]))
+            del self.pending[:IDAT_SIZE]
+
+        self.prior = rows[-1].copy()
+        self.rows += len(rows)
+
+    def close(self):
+        """ Finish the image """
+        if self.file.closed:
+            return
+        if self.rows != self.height:
+            self.file.close()
+            raise ValueError(f"Only {self.rows} of {self.height} rows were written")
+
+        self.pending += self.compressor.flush()
+        for start in range(0, len(self.pending), IDAT_SIZE):
+            self.chunk(b"IDAT", bytes(self.pending[start : start + IDAT_SIZE]))
+        self.chunk(b"IEND", b"")
+        self.file.close()
+
+
+def paeth(rows, above):
+    """ Paeth filter a band of rows, given the raw row above each one """
+    raw = rows.astype(np.int16)
+    up = above.astype(np.int16)
+    left = np.zeros_like(raw)
+    left[:, 1:] = raw[:, :-1]
+    corner = np.zeros_like(up)
+    corner[:, 1:] = up[:, :-1]
+
+    estimate = left + up - corner
+    dist_left = np.abs(estimate - left)
+    dist_up = np.abs(estimate - up)
+    dist_corner = np.abs(estimate - corner)
+
+    predict = np.where(
+        (dist_left <= dist_up) & (dist_left <= dist_corner),
+        left,
+        np.where(dist_up <= dist_corner, up, corner),
+    )
+    return (raw - predict).astype(np.uint8)
@@ -0,0 +1,224 @@
+""" Montage library: Deep Zoom tile pyramid output, built a band of rows at a time
+
+``montage.dzi`` describes the image and ``montage_files/<level>/<col>_<row>.<fmt>``
+holds its tiles, level 0 being a single pixel and the top level full size.
+Rows of the full-size image are fed in from top to bottom: each level cuts
+them into tiles once it has a tile's height of rows, and passes them on,
+halved by 2x2 averaging, to the level below.  Only about one row of tiles
+per level is ever held in memory, however tall the image is.
+
+A digest of every tile's pixels is kept in ``montage_files/tiles.json``, so a
+re-render only encodes and writes the tiles that actually changed.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from lib.pngstream import PngWriter
+from lib.render import save_pixels
+from lib import trace
+
+DZI_XMLNS = "http://schemas.microsoft.com/deepzoom/2008"
+TILE_SIZE = 256
+FORMATS = ("jpg", "png")
+STATE = "tiles.json"
+
+
+def halve(rows):
+    """ Shrink an even number of rows to half size by averaging 2x2 blocks
+
+    An odd last column is doubled up first, so widths round up like Deep Zoom's.
+    """
+    if rows.shape[1] % 2:
+        rows = np.concatenate([rows, rows[:, -1:]], axis=1)
+    wide = rows.astype(np.uint16)
+    total = wide[0::2, 0::2] + wide[1::2, 0::2] + wide[0::2, 1::2] + wide[1::2, 1::2]
+    return ((total + 2) // 4).astype(np.uint8)
+
+
+class Level:
+    """ One level of the pyramid, cutting the rows fed to it into tiles """
+
+    def __init__(self, pyramid, number, below=None):
+        self.pyramid = pyramid
+        self.number = number
+        self.below = below
+        self.rows = []
+        self.held = 0
+        self.tile_row = 0
+        self.spare = None
+
+    def feed(self, rows):
+        """ Take the next rows down, writing out every full row of tiles """
+        if len(rows) == 0:
+            return
+        self.rows.append(rows)
+        self.held += len(rows)
+        size = self.pyramid.tile_size
+        if self.held >= size:
+            block = np.concatenate(self.rows)
+            for start in range(0, len(block) - size + 1, size):
+                self.cut(block[start : start + size])
+            rest = block[len(block) - len(block) % size :]
+            self.rows = [rest] if len(rest) else []
+            self.held = len(rest)
+
+        if self.below is not None:
+            if self.spare is not None:
+                rows = np.concatenate([self.spare, rows])
+            even = len(rows) - len(rows) % 2
+            self.spare = rows[even:] if even < len(rows) else None
+            if even:
+                self.below.feed(halve(rows[:even]))
+
+    def finish(self):
+        """ Write out the last, short, row of tiles and finish the levels below """
+        if self.held:
+            self.cut(np.concatenate(self.rows))
+        if self.below is not None:
+            if self.spare is not None:
+                self.below.feed(halve(np.concatenate([self.spare, self.spare])))
+            self.below.finish()
+
+    def cut(self, block):
+        """ Save one row of tiles """
+        size = self.pyramid.tile_size
+        for col, start in enumerate(range(0, block.shape[1], size)):
+            self.pyramid.save_tile(self.number, col, self.tile_row, block[:, start : start + size])
+        self.tile_row += 1
+
+
+class DeepZoomWriter:  # pylint: disable=too-many-instance-attributes
+    """ Write a Deep Zoom pyramid from successive bands of full-size rows
+
+    Used as a context manager, like PngWriter; the pyramid is only
+    finished if no error got in the way, but the digests of the tiles
+    written so far are kept either way.
+    """
+
+    def __init__(  # pylint: disable=R0913
+        self, filename, width, height, tile_size=TILE_SIZE, fmt="jpg"
+    ):
+        if fmt not in FORMATS:
+            raise ValueError(
+                f"Unknown pyramid format {fmt!r}, expected one of {', '.join(FORMATS)}"
+            )
+        self.filename = filename
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.format = fmt
+        self.folder = f"{os.path.splitext(filename)[0]}_files"
+        self.written = 0
+        self.reused = 0
+
+        self.settings = {"width": width, "height": height, "tile_size": tile_size, "format": fmt}
+        self.known = {}
+        state = os.path.join(self.folder, STATE)
+        if os.path.exists(state):
+            with open(state, encoding="utf-8") as f:
+                saved = json.load(f)
+            if saved.get("settings") == self.settings:
+                self.known = saved["tiles"]
+        self.tiles = {}
+
+        self.top = None
+        for number in range((max(width, height) - 1).bit_length() + 1):
+            self.top = Level(self, number, self.top)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, *exc):
+        if kind is None:
+            self.close()
+        elif os.path.isdir(self.folder):
+            self.save_state(self.known)
+
+    def write(self, rows):
+        """ Append a (rows, width, 3) uint8 band to the image """
+        rows = np.asarray(rows, dtype=np.uint8)
+        if rows.shape[1:] != (self.width, 3):
+            raise ValueError(f"Expected rows {self.width} pixels wide, got {rows.shape}")
+        self.top.feed(rows)
+
+    def tile_path(self, key):
+        """ Where the tile with the given level/col_row key lives """
+        return os.path.join(self.folder, f"{key}.{self.format}")
+
+    def save_tile(self, level, col, row, pixels):
+        """ Encode one tile, unless the same pixels are already on disk """
+        key = f"{level}/{col}_{row}"
+        pixels = np.ascontiguousarray(pixels)
+        digest = hashlib.blake2b(
+            f"{pixels.shape}".encode("utf-8") + pixels.tobytes(), digest_size=16
+        ).hexdigest()
+        self.tiles[key] = digest
+
+        path = self.tile_path(key)
+        if self.known.get(key) == digest and os.path.exists(path):
+            self.reused += 1
+            trace.count("pyramid tiles reused")
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = os.path.join(os.path.dirname(path), f"tmp-{col}_{row}.{self.format}")
+        if self.format == "png":
+            with PngWriter(temp, pixels.shape[1], pixels.shape[0]) as out:
+                out.write(pixels)
+        else:
+            save_pixels(pixels, temp)
+        os.replace(temp, path)
+        self.known[key] = digest
+        self.written += 1
+        trace.count("pyramid tiles written")
+        trace.count("bytes written", os.path.getsize(path))
+
+    def close(self):
+        """ Finish every level, drop tiles left over from before, and write the .dzi """
+        self.top.finish()
+
+        # Anything else in the folder is left from a larger or differently made pyramid
+        keep = {self.tile_path(key) for key in self.tiles}
+        for level in os.listdir(self.folder):
+            path = os.path.join(self.folder, level)
+            if not os.path.isdir(path):
+                continue
+            for name in os.listdir(path):
+                if os.path.join(path, name) not in keep:
+                    os.remove(os.path.join(path, name))
+            if not os.listdir(path):
+                os.rmdir(path)
+        self.save_state(self.tiles)
+
+        with open(f"{self.filename}.tmp", "w", encoding="utf-8") as f:
+            f.write(
+                '<?xml version="1.0" encoding="UTF-8"?>\n'
+                f'<Image xmlns="{DZI_XMLNS}" Format="{self.format}" Overlap="0" '
+                f'TileSize="{self.tile_size}">\n'
+                f'  <Size Width="{self.width}" Height="{self.height}"/>\n'
+                "</Image>\n"
+            )
+        os.replace(f"{self.filename}.tmp", self.filename)
+        print(f"Pyramid {self.filename}: {self.written} tiles written, {self.reused} unchanged")
+
+    def save_state(self, tiles):
+        """ Record the digests of tiles on disk, for the next render to compare against """
+        state = os.path.join(self.folder, STATE)
+        with open(f"{state}.tmp", "w", encoding="utf-8") as f:
+            json.dump({"settings": self.settings, "tiles": tiles}, f)
+        os.replace(f"{state}.tmp", state)
+
+
+def pyramid_writer(config, filename, width, height):
+    """ A DeepZoomWriter with the config's tile size and format """
+    return DeepZoomWriter(
+        filename,
+        width,
+        height,
+        config.get("pyramid_tile_size", TILE_SIZE),
+        config.get("pyramid_format", "jpg"),
+    )
@@ -0,0 +1,187 @@
+""" Montage library: assembling the output image from placed tiles """
+
+import os
+
+from functools import lru_cache, partial
+
+import numpy as np
+
+from wand.image import Image
+
+from lib.montage import image_pixels
+from lib.pngstream import PngWriter
+from lib import trace
+
+
+def load_tile(file, width, height):
+    """ Decode a cached thumbnail, resized to the tile size, into an RGB array """
+    trace.count("tiles decoded")
+    with Image(filename=file) as tile:
+        tile.resize(height=height, width=width)
+        return image_pixels(tile)
+
+
+def tile_source(img, atlas=None, cache_size=None, step=1):
+    """ A function giving the pre-sized tile for a file
+
+    Tiles come from the atlas when there is one, taking every step-th pixel,
+    otherwise they are decoded and kept in an LRU cache of cache_size tiles
+    (unbounded when None).
+    """
+    if atlas is not None:
+        if step > 1:
+            return strided(atlas.tile, step)
+        return atlas.tile
+    loader = partial(load_tile, width=img["pixel_width"], height=img["pixel_height"])
+    return lru_cache(maxsize=cache_size)(loader)
+
+
+def strided(tile_for, step):
+    """ Wrap a tile function to give every step-th pixel of its tiles """
+    return lambda file: tile_for(file)[::step, ::step]
+
+
+def place_tile(canvas, tile, x, y):
+    """ Copy a tile onto the canvas at x, y, clipping whatever hangs off the edge """
+    height = min(tile.shape[0], canvas.shape[0] - y)
+    width = min(tile.shape[1], canvas.shape[1] - x)
+    canvas[y : y + height, x : x + width] = tile[:height, :width]
+
+
+def tile_bands(img, locations):
+    """ Group placements into horizontal bands of tiles
+
+    Returns a list of (start_y, fin_y, [(file, x), ...]) from top to bottom.
+    """
+    rows = {}
+    for file, points in locations.items():
+        for x, y in points:
+            rows.setdefault(y, []).append((file, x))
+
+    starts = sorted(rows)
+    fins = starts[1:] + [img["out_height"]]
+    return [(start, fin, rows[start]) for start, fin in zip(starts, fins)]
+
+
+def draw_band(band, placements, tile_for, tint=None, start_y=0):
+    """ Draw one band of tiles, given (file, x) placements along its top edge
+
+    With a tint, the band starting at start_y is then color corrected.
+    """
+    for file, x in placements:
+        place_tile(band, tile_for(file), x, 0)
+    trace.count("tiles placed", len(placements))
+    if tint is not None:
+        tint.apply(band, start_y)
+
+
+def scaled_layout(img, locations, scale):
+    """ Shrink the output sizes and tile locations by a whole factor
+
+    Tiles are rounded up, so neighbouring tiles may overlap by a pixel
+    rather than leave gaps.
+    """
+    small = dict(img)
+    small["out_width"] = img["out_width"] // scale
+    small["out_height"] = img["out_height"] // scale
+    small["pixel_width"] = -(-img["pixel_width"] // scale)
+    small["pixel_height"] = -(-img["pixel_height"] // scale)
+    moved = {
+        file: [[x // scale, y // scale] for x, y in points] for file, points in locations.items()
+    }
+    return small, moved
+
+
+def render_montage(  # pylint: disable=R0913
+    img, locations, atlas=None, scale=1, tint=None, tile_for=None
+):
+    """ Given the output sizes and the locations for every file, draw the montage
+
+    Each distinct file is decoded once (or taken from the tile atlas, if
+    given) and every placement is a slice copy.  A tile_for function giving
+    full-size tiles may be passed in instead.  A scale above 1 draws a
+    draft at that fraction of the size, and the tint (if any) must be made
+    for the same scale.
+    """
+    if scale > 1:
+        img, locations = scaled_layout(img, locations, scale)
+    if tile_for is None:
+        tile_for = tile_source(img, atlas, step=scale)
+    elif scale > 1:
+        tile_for = strided(tile_for, scale)
+    canvas = np.zeros((img["out_height"], img["out_width"], 3), dtype=np.uint8)
+    for start_y, fin_y, placements in tile_bands(img, locations):
+        draw_band(canvas[start_y:fin_y], placements, tile_for, tint, start_y)
+    return canvas
+
+
+def montage_bands(  # pylint: disable=R0913
+    img, locations, atlas=None, cache_size=1024, tint=None, tile_for=None
+):
+    """ Draw the montage one band of tiles at a time, yielding the bands top to bottom
+
+    Only the band being drawn and up to cache_size decoded tiles are held in
+    memory, however large the output is.
+    """
+    if tile_for is None:
+        tile_for = tile_source(img, atlas, cache_size)
+    for start_y, fin_y, placements in tile_bands(img, locations):
+        band = np.zeros((fin_y - start_y, img["out_width"], 3), dtype=np.uint8)
+        draw_band(band, placements, tile_for, tint, start_y)
+        yield band
+
+
+def stream_montage(  # pylint: disable=R0913
+    img, locations, filename, atlas=None, cache_size=1024, tint=None, tile_for=None
+):
+    """ Draw the montage one band of tiles at a time, straight into a PNG """
+    with PngWriter(filename, img["out_width"], img["out_height"]) as out:
+        for band in montage_bands(img, locations, atlas, cache_size, tint, tile_for):
+            out.write(band)
+    trace.count("bytes written", os.path.getsize(filename))
+
+
+def pixelated(img, bigpixels, scale=1):
+    """ Draw the flat-color "pixelated" reference as an RGB array
+
+    Big pixels form a grid, so a small array of their colors only needs its
+    rows and columns repeating out to each big pixel's size.
+    """
+    columns, col = np.unique([bp[0] for bp in bigpixels], return_inverse=True)
+    rows, row = np.unique([bp[1] for bp in bigpixels], return_inverse=True)
+    colors = np.zeros((len(rows), len(columns), 3), dtype=np.uint8)
+    colors[row, col] = [bp[4] for bp in bigpixels]
+
+    widths = np.diff(np.append(columns, img["out_width"]) // scale)
+    heights = np.diff(np.append(rows, img["out_height"]) // scale)
+    return np.repeat(np.repeat(colors, heights, axis=0), widths, axis=1)
+
+
+def stream_pixelated(img, bigpixels, filename):
+    """ Draw the flat-color "pixelated" reference one band at a time, into a PNG """
+    print(f"Writing pixelated output for reference: {filename}")
+    rows = {}
+    for bp in bigpixels:
+        rows.setdefault((bp[1], bp[3]), []).append(bp)
+
+    with PngWriter(filename, img["out_width"], img["out_height"]) as out:
+        for start_y, fin_y in sorted(rows):
+            band = np.zeros((fin_y - start_y, img["out_width"], 3), dtype=np.uint8)
+            for bp in rows[(start_y, fin_y)]:
+                band[:, bp[0] : bp[2]] = bp[4]
+            out.write(band)
+    trace.count("bytes written", os.path.getsize(filename))
+
+
+def save_pixels(pixels, filename):
+    """ Encode an RGB array to the given file """
+    height, width = pixels.shape[:2]
+    with Image(
+        blob=np.ascontiguousarray(pixels).tobytes(),
+        format="RGB",
+        width=width,
+        height=height,
+        depth=8,
+    ) as out:
+        out.save(filename=filename)
+    trace.count("bytes written", os.path.getsize(filename))
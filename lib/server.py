@@ -0,0 +1,220 @@
+""" Montage library: a long-running render service that keeps the palette warm
+
+The service holds the palette, its color matcher, the match indexes and the
+decoded tiles between jobs, reloading them only when the palette on disk
+changes version.  Jobs (a goal image, an output file and any config
+overrides) are queued and run on a pool of threads.  A small JSON-over-HTTP
+front end lets other processes submit jobs and check on them.
+"""
+
+import itertools
+import json
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache, partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from lib.atlas import TileAtlas
+from lib.build import (
+    BUILD_KEYS,
+    INDEX_KEYS,
+    find_locations,
+    goal_layout,
+    match_indexes,
+    write_montage,
+)
+from lib.matcher import ColorMatcher
+from lib.montage import calculate_big_pixels
+from lib.render import load_tile
+from lib.store import PaletteStore, palette_version
+
+# Config keys a job may override; the rest would need a different palette
+JOB_KEYS = BUILD_KEYS
+
+
+class RenderService:  # pylint: disable=too-many-instance-attributes
+    """ Queue of montage jobs run against one warm palette """
+
+    def __init__(self, config, workers=2):
+        self.config = config
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.jobs = {}
+        self.futures = {}
+        self.warm = None
+        self.indexes = {}
+        self.tiles = {}
+
+    def palette(self):
+        """ The (version, palette, matcher) for the palette on disk, reloaded when it changes """
+        with self.lock:
+            version = palette_version(self.config["palette"])
+            if self.warm is None or self.warm[0] != version:
+                cache = PaletteStore(self.config["palette"])
+                if len(cache) == 0:
+                    raise ValueError(f"NO CACHE: {cache.path}")
+                print(f"Loaded {len(cache)} potential pixel images (palette {cache.version})")
+                self.warm = (cache.version, cache, ColorMatcher(cache.colors))
+                self.indexes.clear()
+                self.tiles.clear()
+            return self.warm
+
+    def match_indexes(self, config, cache):
+        """ The (lut, signatures) for a job's config, built once per palette version """
+        key = (cache.version, tuple(config.get(k) for k in INDEX_KEYS))
+        with self.lock:
+            if key not in self.indexes:
+                self.indexes[key] = match_indexes(config, cache)
+            return self.indexes[key]
+
+    def tile_source(self, cache, width, height):
+        """ A function giving full-size tiles, shared by every job with the same tile size """
+        key = (cache.version, width, height)
+        with self.lock:
+            if key not in self.tiles:
+                if self.config.get("atlas"):
+                    atlas = TileAtlas(cache, width, height).load(self.config.get("workers", 0))
+                    self.tiles[key] = atlas.tile
+                else:
+                    loader = partial(load_tile, width=width, height=height)
+                    self.tiles[key] = lru_cache(self.config.get("tile_cache", 1024))(loader)
+            return self.tiles[key]
+
+    def submit(self, goal, output, draft=0, overrides=None):
+        """ Queue a job, returning its status record """
+        overrides = dict(overrides or {})
+        unknown = sorted(set(overrides) - set(JOB_KEYS))
+        if unknown:
+            raise ValueError(f"Jobs cannot override {', '.join(unknown)}")
+        if not os.path.exists(goal):
+            raise ValueError(f"No such goal image: {goal}")
+
+        job = {
+            "id": next(self.ids),
+            "goal": goal,
+            "output": output,
+            "draft": draft,
+            "config": overrides,
+            "status": "queued",
+            "submitted": time.time(),
+        }
+        with self.lock:
+            self.jobs[job["id"]] = job
+            self.futures[job["id"]] = self.pool.submit(self.run, job)
+        return dict(job)
+
+    def run(self, job):
+        """ Run a queued job, recording how it went """
+        job["status"] = "running"
+        job["started"] = time.time()
+        try:
+            job["output"] = self.render(job["goal"], job["output"], job["draft"], job["config"])
+            job["status"] = "done"
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            job["status"] = "failed"
+            job["error"] = f"{type(err).__name__}: {err}"
+        job["finished"] = time.time()
+
+    def render(self, goal, output, draft=0, overrides=None):
+        """ Build one montage against the warm palette; returns the file written """
+        config = {**self.config, **(overrides or {})}
+        _, cache, matcher = self.palette()
+
+        img = goal_layout(config, goal)
+        with img["ref"]:
+            bigpixels = calculate_big_pixels(
+                img, config["upscale"], config.get("signature_grid", 0)
+            )
+            locations = find_locations(
+                config, cache, bigpixels, self.match_indexes(config, cache), matcher
+            )
+            tile_for = self.tile_source(cache, img["pixel_width"], img["pixel_height"])
+            return write_montage(
+                config, cache, img, bigpixels, locations, output, draft, tile_for
+            )
+
+    def status(self, job_id=None):
+        """ The status record of one job, or of every job """
+        with self.lock:
+            if job_id is None:
+                return [dict(job) for job in self.jobs.values()]
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def wait(self, job_ids=None):
+        """ Block until the given jobs (or all of them) have finished """
+        with self.lock:
+            ids = list(self.futures) if job_ids is None else job_ids
+            futures = [self.futures[job_id] for job_id in ids]
+        wait(futures)
+        return [self.status(job_id) for job_id in ids]
+
+
+def make_handler(service):
+    """ An HTTP request handler class bound to the given service
+
+    ``POST /jobs`` takes {"goal", "output", "draft", "config"} and answers
+    with the queued job, ``GET /jobs`` lists every job and ``GET /jobs/<id>``
+    shows one.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        """ JSON front end to the render service """
+
+        def reply(self, code, body):
+            """ Send a JSON response """
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            """ Job status """
+            parts = self.path.strip("/").split("/")
+            if parts == ["jobs"]:
+                self.reply(200, service.status())
+            elif len(parts) == 2 and parts[0] == "jobs" and parts[1].isdigit():
+                job = service.status(int(parts[1]))
+                self.reply(200 if job else 404, job or {"error": "No such job"})
+            else:
+                self.reply(404, {"error": "Not found"})
+
+        def do_POST(self):  # pylint: disable=invalid-name
+            """ Job submission """
+            if self.path.strip("/") != "jobs":
+                self.reply(404, {"error": "Not found"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                job = service.submit(
+                    request["goal"],
+                    request["output"],
+                    int(request.get("draft", 0)),
+                    request.get("config"),
+                )
+            except (KeyError, TypeError, ValueError) as err:
+                self.reply(400, {"error": f"{type(err).__name__}: {err}"})
+                return
+            self.reply(202, job)
+
+    return Handler
+
+
+def serve(service, host="127.0.0.1", port=8765):
+    """ Answer HTTP requests for the service until interrupted """
+    httpd = ThreadingHTTPServer((host, port), make_handler(service))
+    print(f"Serving montage jobs on http://{host}:{port}/jobs")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        service.pool.shutdown(wait=True)
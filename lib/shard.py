@@ -0,0 +1,215 @@
+""" Montage library: rendering the montage across worker processes, a strip at a time
+
+Once every tile is placed, the rows of tiles can be drawn independently.  The
+bands of tiles are cut into strips of about equal work and queued as files
+in a scratch directory: each worker claims a strip by renaming its file (an
+atomic step, so no two workers draw the same strip), draws it exactly as the
+single-process render would, and leaves it as a ``.npy`` partial with the
+work it counted beside it.  The partials are stitched together in strip
+order as they arrive, so the output does not depend on which worker drew
+what, or when.
+"""
+
+import json
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from lib.parallel import worker_count
+from lib.pngstream import PngWriter
+from lib.pyramid import pyramid_writer
+from lib.render import draw_band, save_pixels, tile_bands, tile_source
+from lib import trace
+
+# Strips queued per worker, so a slow strip doesn't leave the others idle
+STRIPS_PER_WORKER = 4
+# Seconds between looks for the next partial
+POLL = 0.01
+
+
+def strips(bands, count):
+    """ Cut the bands into up to count runs of about equal numbers of tiles
+
+    Returns (first, last) band index ranges, in order, covering every band.
+    """
+    if not bands:
+        return []
+    total = sum(len(placements) for _, _, placements in bands)
+    cuts = []
+    start = done = 0
+    for index, (_, _, placements) in enumerate(bands):
+        done += len(placements)
+        if done * count >= total * (len(cuts) + 1) and index + 1 < len(bands):
+            cuts.append((start, index + 1))
+            start = index + 1
+    cuts.append((start, len(bands)))
+    return cuts
+
+
+def draw_strip(img, bands, tile_for, tint=None):
+    """ Draw a run of bands into one array, as render_montage draws them """
+    top = bands[0][0]
+    strip = np.zeros((bands[-1][1] - top, img["out_width"], 3), dtype=np.uint8)
+    for start_y, fin_y, placements in bands:
+        draw_band(strip[start_y - top : fin_y - top], placements, tile_for, tint, start_y)
+    return strip
+
+
+def claim(queue):
+    """ Yield the strip numbers this worker wins from the queue, until it is empty """
+    todo = os.path.join(queue, "todo")
+    for name in sorted(os.listdir(todo)):
+        try:
+            os.rename(os.path.join(todo, name), os.path.join(queue, "claimed", name))
+        except FileNotFoundError:
+            continue
+        yield int(name)
+
+
+def shard_worker(queue):
+    """ Worker process: draw claimed strips until none are left """
+    with open(os.path.join(queue, "job.pickle"), "rb") as f:
+        job = pickle.load(f)
+
+    if job["atlas"]:
+        tile_for = atlas_tiles(job["atlas"], job["atlas_rows"])
+    else:
+        tile_for = tile_source(job["img"], None, job["tile_cache"])
+
+    for number in claim(queue):
+        first, last = job["strips"][number]
+        strip, counts = trace.collect(
+            draw_strip, job["img"], job["bands"][first:last], tile_for, job["tint"]
+        )
+        partial = os.path.join(queue, "done", f"{number:05}.npy")
+        with open(counted(partial), "w", encoding="utf-8") as f:
+            json.dump(counts, f)
+        with open(f"{partial}.tmp", "wb") as f:
+            np.save(f, strip)
+        os.replace(f"{partial}.tmp", partial)
+
+
+def atlas_tiles(path, rows):
+    """ A tile function reading the atlas the parent already built, given each file's row
+
+    The atlas is only ever mapped read-only here, never built.
+    """
+    tiles = np.load(path, mmap_mode="r")
+    return lambda file: tiles[rows[file]]
+
+
+@trace.span("shards")
+def shard_montage(  # pylint: disable=R0913,R0914
+    config, img, locations, filename, tint=None, workers=0, atlas=None
+):
+    """ Draw the montage over a pool of worker processes, then stitch it into filename
+
+    Workers map the loaded atlas, when given, from its path; without one they
+    decode their own tiles, so a tile used in several workers' strips is
+    decoded once in each.  A .dzi filename gets a Deep Zoom pyramid, fed
+    each strip as it arrives.  With stream set, the partials are encoded one
+    at a time and only one strip is ever in memory.
+    """
+    workers = worker_count(workers)
+    bands = tile_bands(img, locations)
+    cuts = strips(bands, workers * STRIPS_PER_WORKER)
+    print(f"Rendering {len(cuts)} strips over {workers} worker processes")
+
+    queue = tempfile.mkdtemp(
+        prefix="montage-shards-", dir=os.path.dirname(os.path.abspath(filename))
+    )
+    pool = []
+    try:
+        for part in ("todo", "claimed", "done"):
+            os.mkdir(os.path.join(queue, part))
+        with open(os.path.join(queue, "job.pickle"), "wb") as f:
+            pickle.dump(
+                {
+                    "img": {key: value for key, value in img.items() if key != "ref"},
+                    "bands": bands,
+                    "strips": cuts,
+                    "tint": tint,
+                    "atlas": atlas.path if atlas is not None else None,
+                    "atlas_rows": (
+                        {file: atlas.palette.index[file] for file in locations}
+                        if atlas is not None
+                        else None
+                    ),
+                    "tile_cache": config.get("tile_cache", 1024) if config.get("stream") else None,
+                },
+                f,
+            )
+        for number in range(len(cuts)):
+            with open(os.path.join(queue, "todo", f"{number:05}"), "wb"):
+                pass
+
+        pool = [
+            multiprocessing.Process(target=shard_worker, args=(queue,))
+            for _ in range(min(workers, len(cuts)))
+        ]
+        for process in pool:
+            process.start()
+
+        partials = [os.path.join(queue, "done", f"{number:05}.npy") for number in range(len(cuts))]
+        if filename.endswith(".dzi"):
+            with pyramid_writer(config, filename, img["out_width"], img["out_height"]) as out:
+                for partial in arrivals(partials, pool):
+                    out.write(np.load(partial, mmap_mode="r"))
+                    os.remove(partial)
+        else:
+            stitch(img, arrivals(partials, pool), filename, config.get("stream", False))
+    finally:
+        for process in pool:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        shutil.rmtree(queue, ignore_errors=True)
+
+
+def arrivals(partials, pool):
+    """ Yield each partial, in order, as soon as a worker has written it
+
+    The work its worker counted drawing it is added to the trace here.
+    """
+    for partial in partials:
+        while not os.path.exists(partial):
+            if not any(process.is_alive() for process in pool) and not os.path.exists(partial):
+                raise RuntimeError(f"Strip {os.path.basename(partial)} failed to render")
+            time.sleep(POLL)
+        with open(counted(partial), encoding="utf-8") as f:
+            trace.merge(json.load(f))
+        os.remove(counted(partial))
+        yield partial
+
+
+def counted(partial):
+    """ File alongside a partial holding the work counted drawing it """
+    return f"{os.path.splitext(partial)[0]}.json"
+
+
+def stitch(img, partials, filename, stream=False):
+    """ Join the strip partials, top to bottom, into the output image
+
+    Streamed, each partial is encoded and deleted as soon as it is reached,
+    so encoding overlaps the drawing of later strips.
+    """
+    if stream:
+        with PngWriter(filename, img["out_width"], img["out_height"]) as out:
+            for partial in partials:
+                out.write(np.load(partial, mmap_mode="r"))
+                os.remove(partial)
+        trace.count("bytes written", os.path.getsize(filename))
+        return
+
+    canvas = np.zeros((img["out_height"], img["out_width"], 3), dtype=np.uint8)
+    top = 0
+    for partial in partials:
+        strip = np.load(partial, mmap_mode="r")
+        canvas[top : top + len(strip)] = strip
+        top += len(strip)
+    save_pixels(canvas, filename)
@@ -0,0 +1,99 @@
+""" Montage library: approximate nearest-signature index over the palette
+
+Grid signatures are 3k^2 values long, too many dimensions for the grid index
+behind ColorMatcher.  They are projected onto their leading principal
+components instead, a ColorMatcher over the projections gathers the nearest
+few candidates per tile, and those are re-ranked by their full signature
+distance.  The projection is cached next to the palette, keyed by palette
+version.
+"""
+
+import os
+
+import numpy as np
+
+from lib.matcher import ColorMatcher
+
+# Principal components kept for the candidate search
+COMPONENTS = 3
+
+# Candidates gathered per tile for exact re-ranking
+CANDIDATES = 64
+
+# Tiles re-ranked in one numpy call
+RERANK_CHUNK = 4096
+
+
+class SignatureIndex:
+    """ PCA-projected grid index with exact re-ranking over palette signatures """
+
+    def __init__(self, palette, candidates=CANDIDATES):
+        if palette.grid == 0:
+            raise ValueError(f"{palette.path} was built without signatures")
+        self.palette = palette
+        self.candidates = candidates
+        self.path = f"{palette.path}.sig-{palette.grid}.npz"
+        self.signatures = np.asarray(palette.signatures, dtype=np.float64)
+        self.mean = None
+        self.basis = None
+        self.matcher = None
+
+    def load(self):
+        """ Read the cached projection for this palette version, building it if needed """
+        if os.path.exists(self.path):
+            with np.load(self.path) as cached:
+                if str(cached["version"]) == self.palette.version:
+                    self.mean = cached["mean"]
+                    self.basis = cached["basis"]
+                    self.matcher = ColorMatcher(cached["projected"])
+                    return self
+
+        projected = self.build()
+        with open(f"{self.path}.tmp", "wb") as f:
+            np.savez(
+                f,
+                version=self.palette.version,
+                mean=self.mean,
+                basis=self.basis,
+                projected=projected,
+            )
+        os.replace(f"{self.path}.tmp", self.path)
+        return self
+
+    def build(self):
+        """ Find the principal components of the palette signatures and project onto them """
+        print(f"Building signature index over {len(self.palette)} images")
+        self.mean = self.signatures.mean(axis=0)
+        centered = self.signatures - self.mean
+        _, _, components = np.linalg.svd(centered, full_matrices=False)
+        self.basis = components[:COMPONENTS].T
+        projected = centered @ self.basis
+        self.matcher = ColorMatcher(projected)
+        return projected
+
+    def match(self, targets, color_distance, rng=None):
+        """ Pick a palette row for every target signature
+
+        Distances are the root mean square over grid cells of the RGB
+        distance, so ``color_distance`` means what it does for plain colors.
+        Of the candidates within it of the closest, one is chosen at random.
+        Returns the chosen rows and their distances.
+        """
+        rng = rng or np.random.default_rng()
+        targets = np.array(targets, dtype=np.float64, ndmin=2)
+        cells = targets.shape[1] / 3
+
+        chosen = np.empty(len(targets), dtype=np.intp)
+        delta = np.empty(len(targets), dtype=np.float64)
+        rows, _ = self.matcher.nearest((targets - self.mean) @ self.basis, self.candidates)
+        for start in range(0, len(targets), RERANK_CHUNK):
+            part = slice(start, start + RERANK_CHUNK)
+            offset = self.signatures[rows[part]] - targets[part, None, :]
+            dist = np.sqrt(np.einsum("ijk,ijk->ij", offset, offset) / cells)
+
+            # Random keys pick uniformly among the candidates inside the band
+            inside = dist <= dist.min(axis=1, keepdims=True) + color_distance
+            pick = np.where(inside, rng.random(dist.shape), -1).argmax(axis=1)
+            chosen[part] = rows[part][np.arange(len(pick)), pick]
+            delta[part] = dist[np.arange(len(pick)), pick]
+        return chosen, delta
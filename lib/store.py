@@ -0,0 +1,206 @@
+""" Montage library: compact on-disk palette store
+
+A palette is two files.  ``<name>`` holds a fixed header followed by an
+(N, channels) uint8 matrix that is memory-mapped on load, and
+``<name>.paths`` holds the matching newline separated path table.  New
+entries are appended to both and the header is rewritten last, so a
+half-finished append is simply ignored on the next load.
+
+Every row starts with the average RGB color.  Palettes built with
+signatures carry a k x k grid of RGB averages after it, so channels is
+3 + 3k^2.
+"""
+
+import json
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b"MONTAGE\0"
+VERSION = 1
+CHANNELS = 3
+
+# magic, format version, channels, entry count, paths table bytes, stamp
+HEADER = struct.Struct("<8sHHQQQ")
+
+
+class PaletteStore:  # pylint: disable=too-many-instance-attributes
+    """ A palette of image paths and their average colors (and signatures) """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.paths_file = f"{self.path}.paths"
+        self.paths = []
+        self.channels = CHANNELS
+        self.values = np.empty((0, CHANNELS), dtype=np.uint8)
+        self.index = {}
+        self.stamp = 0
+        self._paths_bytes = 0
+        self.load()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, path):
+        return str(path) in self.index
+
+    @property
+    def colors(self):
+        """ (N, 3) average colors """
+        return self.values[:, :CHANNELS]
+
+    @property
+    def signatures(self):
+        """ (N, 3k^2) grid signatures; empty columns if the palette has none """
+        return self.values[:, CHANNELS:]
+
+    @property
+    def grid(self):
+        """ Side of the signature grid, or 0 without signatures """
+        return int(round(((self.channels - CHANNELS) / CHANNELS) ** 0.5))
+
+    @property
+    def version(self):
+        """ Identifier that changes every time the palette is written """
+        return f"{self.stamp:016x}"
+
+    def get(self, path):
+        """ Color of the given path, or None if it isn't in the palette """
+        row = self.index.get(str(path))
+        if row is None:
+            return None
+        return self.colors[row].tolist()
+
+    def load(self):
+        """ (Re)read the palette from disk, importing an old pickledb file if found """
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, "rb") as f:
+            head = f.read(HEADER.size)
+
+        if not head.startswith(MAGIC):
+            import_pickledb(self.path)
+            with open(self.path, "rb") as f:
+                head = f.read(HEADER.size)
+
+        magic, version, channels, count, self._paths_bytes, self.stamp = HEADER.unpack(head)
+        if magic != MAGIC or version != VERSION or channels < CHANNELS:
+            raise ValueError(f"{self.path} is not a version {VERSION} palette")
+        self.channels = channels
+
+        with open(self.paths_file, "rb") as f:
+            table = f.read(self._paths_bytes).decode("utf-8")
+        self.paths = table.split("\n")[:count]
+        self.index = {path: row for row, path in enumerate(self.paths)}
+
+        if count:
+            self.values = np.memmap(
+                self.path, dtype=np.uint8, mode="r", offset=HEADER.size, shape=(count, channels)
+            )
+        else:
+            self.values = np.empty((0, channels), dtype=np.uint8)
+
+    def append(self, entries):
+        """ Add (path, row) entries; paths already present have their row replaced
+
+        A row is the average color, followed by the signature if the palette
+        has them.  An empty palette takes on the width of the new rows.
+        """
+        updates = {}
+        added = {}
+        for path, values in entries:
+            path = str(path)
+            if path in self.index:
+                updates[self.index[path]] = values
+            else:
+                added[path] = values
+
+        if not updates and not added:
+            return
+        width = len(next(iter({**updates, **added}.values())))
+        if not self.paths:
+            self.write([], [], width)
+        elif width != self.channels:
+            raise ValueError(f"{self.path} holds {self.channels} channels per entry, not {width}")
+
+        count = len(self.paths)
+        with open(self.path, "r+b") as f:
+            for row, values in updates.items():
+                f.seek(HEADER.size + row * self.channels)
+                f.write(np.asarray(values, dtype=np.uint8).tobytes())
+
+            if added:
+                f.seek(HEADER.size + count * self.channels)
+                values = np.asarray(list(added.values()), dtype=np.uint8)
+                f.write(values.reshape(-1, self.channels).tobytes())
+                f.truncate()
+
+                with open(self.paths_file, "r+b") as paths:
+                    paths.truncate(self._paths_bytes)
+                    paths.seek(self._paths_bytes)
+                    paths.write("".join(f"{path}\n" for path in added).encode("utf-8"))
+                    self._paths_bytes = paths.tell()
+
+            f.seek(0)
+            f.write(self._header(count + len(added)))
+
+        self.load()
+
+    def remove(self, paths):
+        """ Drop the given paths from the palette, rewriting it """
+        drop = {self.index[str(path)] for path in paths if str(path) in self.index}
+        if not drop:
+            return
+
+        keep = [row for row in range(len(self.paths)) if row not in drop]
+        self.write([self.paths[row] for row in keep], self.values[keep], self.channels)
+
+    def write(self, paths, values, channels=CHANNELS):
+        """ Replace the whole palette with the given paths and rows of channels values """
+        values = np.asarray(values, dtype=np.uint8).reshape(-1, channels)
+        self.channels = channels
+        table = "".join(f"{path}\n" for path in paths).encode("utf-8")
+
+        with open(f"{self.paths_file}.tmp", "wb") as f:
+            f.write(table)
+        self._paths_bytes = len(table)
+        with open(f"{self.path}.tmp", "wb") as f:
+            f.write(self._header(len(paths)))
+            f.write(values.tobytes())
+
+        os.replace(f"{self.paths_file}.tmp", self.paths_file)
+        os.replace(f"{self.path}.tmp", self.path)
+        self.load()
+
+    def _header(self, count):
+        """ A fresh header for a palette of count entries """
+        self.stamp = int.from_bytes(os.urandom(8), "little")
+        return HEADER.pack(MAGIC, VERSION, self.channels, count, self._paths_bytes, self.stamp)
+
+
+def palette_version(path):
+    """ The version of the palette on disk, from its header alone, or None if there is none """
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        head = f.read(HEADER.size)
+    if len(head) < HEADER.size or not head.startswith(MAGIC):
+        return None
+    return f"{HEADER.unpack(head)[5]:016x}"
+
+
+def import_pickledb(path):
+    """ Convert a pickledb JSON palette into a palette store, in place
+
+    The original JSON is kept alongside as ``<name>.json``.
+    """
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+
+    os.replace(path, f"{path}.json")
+    store = PaletteStore(path)
+    store.write(list(data.keys()), list(data.values()))
+    print(f"Imported {len(data)} entries from the old palette into {path}")
+    return store
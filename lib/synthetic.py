@@ -0,0 +1,78 @@
+""" Montage library: seeded synthetic source libraries and goal images for benchmarks
+
+Every image is a function of the seed and its index alone, so a library can
+be regenerated bit for bit anywhere.
+"""
+
+import json
+import os
+
+import numpy as np
+
+from lib.render import save_pixels
+
+SIZES = ((320, 240), (640, 480), (1024, 768), (480, 640))
+FORMATS = ("jpg", "png")
+STAMP = ".library.json"
+
+
+def synthetic_pixels(rng, width, height):
+    """ A photo-ish RGB array: a two-color gradient with a few blocks and some noise """
+    angle = rng.uniform(0, 2 * np.pi)
+    ys, xs = np.indices((height, width), dtype=np.float32)
+    ramp = xs * np.cos(angle) / width + ys * np.sin(angle) / height
+    ramp = (ramp - ramp.min()) / max(np.ptp(ramp), 1e-6)
+
+    start, end = rng.uniform(0, 255, size=(2, 3)).astype(np.float32)
+    pixels = start + ramp[..., None] * (end - start)
+
+    for _ in range(rng.integers(0, 5)):
+        x0, x1 = np.sort(rng.integers(0, width, size=2))
+        y0, y1 = np.sort(rng.integers(0, height, size=2))
+        pixels[y0:y1, x0:x1] = rng.uniform(0, 255, size=3)
+
+    pixels += rng.normal(0, 8, size=pixels.shape).astype(np.float32)
+    return np.clip(np.rint(pixels), 0, 255).astype(np.uint8)
+
+
+def make_library(directory, count, seed=0, sizes=SIZES, formats=FORMATS):
+    """ Write count synthetic source images under directory, returning their paths
+
+    Images are spread over subdirectories of a hundred, like a photo
+    library, in a mix of the given sizes and formats.  A library already
+    written to the directory with the same settings is reused as it is.
+    """
+    settings = {
+        "count": count,
+        "seed": seed,
+        "sizes": [list(size) for size in sizes],
+        "formats": list(formats),
+    }
+    stamp = os.path.join(directory, STAMP)
+    reuse = False
+    if os.path.exists(stamp):
+        with open(stamp, encoding="utf-8") as f:
+            reuse = json.load(f) == settings
+
+    paths = []
+    for index in range(count):
+        rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(0, index)))
+        size = sizes[rng.integers(len(sizes))]
+        fmt = formats[rng.integers(len(formats))]
+        path = os.path.join(directory, f"{index // 100:03}", f"img{index:06}.{fmt}")
+        if not reuse:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            save_pixels(synthetic_pixels(rng, *size), path)
+        paths.append(path)
+
+    if not reuse:
+        with open(stamp, "w", encoding="utf-8") as f:
+            json.dump(settings, f)
+    return paths
+
+
+def make_goal(filename, width, height, seed=0):
+    """ Write a synthetic goal image of the given size """
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(1,)))
+    save_pixels(synthetic_pixels(rng, width, height), filename)
+    return filename
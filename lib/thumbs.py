@@ -0,0 +1,24 @@
+""" Montage library: making thumbnails across a pool of worker processes """
+
+from lib.montage import makethumb
+from lib.parallel import parallel_map
+
+
+def thumbnail(job):
+    """ Given a (path, outfile, height_ratio, pref_width, pref_height, grid) job, make the thumbnail
+
+    Returns (job, start size, end size, fast, row, digest, error) where fast
+    is True when the source was decoded at reduced size, row is the
+    thumbnail's palette row (None if its depth is too shallow), digest is its
+    difference hash, and error is None on success.
+    """
+    try:
+        start_xy, end_xy, fast, row, digest = makethumb(*job)
+    except Exception as err:  # pylint: disable=broad-exception-caught
+        return job, None, None, False, None, None, f"{type(err).__name__}: {err}"
+    return job, start_xy, end_xy, fast, row, digest, None
+
+
+def make_thumbnails(jobs, workers=0):
+    """ Make thumbnails for every job, yielding results in order as they finish """
+    return parallel_map(thumbnail, jobs, workers, chunksize=4)
@@ -0,0 +1,68 @@
+""" Montage library: color correction of placed tiles toward their big pixel's color
+
+Correction runs on a whole band of placed tiles at once, right after the
+band is drawn, so streamed and in-memory renders come out the same.  Per
+tile means are column sums over the band, and the per-tile corrections are
+repeated out to the band's width before one blend over every pixel.
+"""
+
+import numpy as np
+
+from lib.montage import image_pixels
+
+MODES = ("add", "multiply", "overlay")
+
+
+class Tint:  # pylint: disable=too-many-instance-attributes,too-few-public-methods
+    """ Blend every placed tile toward its target by a fixed strength
+
+    ``add`` shifts a tile so its mean moves toward the target color,
+    ``multiply`` scales its channels to do the same, and ``overlay``
+    alpha-blends the matching region of the goal image over it.
+    """
+
+    def __init__(self, mode, strength, img, bigpixels, scale=1):  # pylint: disable=R0913
+        if mode not in MODES:
+            raise ValueError(f"Unknown tint mode {mode!r}, expected one of {', '.join(MODES)}")
+        self.mode = mode
+        self.strength = strength
+
+        columns, col = np.unique([bp[0] for bp in bigpixels], return_inverse=True)
+        rows, row = np.unique([bp[1] for bp in bigpixels], return_inverse=True)
+        self.colors = np.zeros((len(rows), len(columns), 3), dtype=np.float64)
+        self.colors[row, col] = [bp[4] for bp in bigpixels]
+
+        self.width = img["out_width"] // scale
+        self.rows = rows // scale
+        self.starts = columns // scale
+        self.widths = np.diff(np.append(self.starts, self.width))
+
+        self.goal = self.step = None
+        if mode == "overlay":
+            self.goal = image_pixels(img["ref"])
+            self.step = scale * self.goal.shape[1] / img["out_width"]
+
+    def apply(self, band, start_y):
+        """ Correct a drawn band of tiles, in place, given its top edge """
+        pixels = band.astype(np.float64)
+        if self.mode == "overlay":
+            region = self.goal[
+                ((start_y + np.arange(band.shape[0])) * self.step).astype(np.intp)
+            ][:, (np.arange(band.shape[1]) * self.step).astype(np.intp)]
+            pixels += self.strength * (region - pixels)
+        else:
+            keep = self.widths > 0
+            starts = self.starts[keep]
+            widths = self.widths[keep]
+            target = self.colors[np.searchsorted(self.rows, start_y)][keep]
+            means = np.add.reduceat(pixels.sum(axis=0), starts, axis=0)
+            means /= (widths * band.shape[0])[:, None]
+
+            if self.mode == "add":
+                shift = self.strength * (target - means)
+                pixels += np.repeat(shift, widths, axis=0)
+            else:
+                factor = 1 + self.strength * (target / np.maximum(means, 1) - 1)
+                pixels *= np.repeat(factor, widths, axis=0)
+
+        band[...] = np.clip(np.rint(pixels), 0, 255)
@@ -0,0 +1,237 @@
+""" Montage library: per-stage timing, work counters and peak memory, as a Chrome trace
+
+Stages are wrapped in ``span``, which records their wall and CPU time, the
+work counted during them and the peak resident size so far.  Work is
+tallied with ``count``; work done in worker processes is gathered there
+with ``collect`` and added back in the parent with ``merge``.  Nothing is
+recorded until ``setup`` turns tracing on; the trace is then written when
+the script exits, ready to load in chrome://tracing or Perfetto, with a
+per-stage summary under "otherData".
+
+Quiet mode swaps the per-item lines the scripts print (one per thumbnail,
+palette entry or tile) for a running tally every few seconds and a one
+line summary as each stage ends.
+"""
+
+import atexit
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # resource is Unix only
+    resource = None
+
+# Seconds between running tallies in quiet mode
+SUMMARY_EVERY = 5.0
+
+
+class Tracer:  # pylint: disable=too-many-instance-attributes
+    """ Everything recorded so far in this process """
+
+    def __init__(self):
+        self.path = None
+        self.quiet = False
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.events = []
+        self.counters = {}
+        self.stages = {}
+        self.kinds = []
+        self.tallied = time.monotonic()
+        self.collecting = False
+
+    def active(self):
+        """ Whether spans and counters are being recorded """
+        return self.path is not None or self.quiet
+
+    def stamp(self):
+        """ Microseconds since the tracer started, as Chrome traces count time """
+        return (time.perf_counter() - self.origin) * 1e6
+
+
+TRACER = Tracer()
+
+
+def setup(config, path=None, quiet_mode=None):
+    """ Turn tracing and quiet mode on as the config (or the arguments) say
+
+    The trace goes to path, else the config's trace_file, and is written
+    when the process exits.
+    """
+    TRACER.path = path or config.get("trace_file") or None
+    TRACER.quiet = config.get("quiet", False) if quiet_mode is None else quiet_mode
+    if TRACER.path:
+        atexit.register(finish)
+
+
+def quiet():
+    """ Whether per-item lines are being left out """
+    return TRACER.quiet
+
+
+def enabled():
+    """ Whether a trace is being recorded """
+    return TRACER.path is not None
+
+
+def peak_rss():
+    """ Peak resident size of this process, and of its finished children, in bytes """
+    if resource is None:
+        return 0, 0
+    scale = 1 if sys.platform == "darwin" else 1024
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+    )
+
+
+def cpu_time():
+    """ CPU seconds used by this process and its finished children, such as worker pools """
+    used = time.process_time()
+    if resource is not None:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        used += children.ru_utime + children.ru_stime
+    return used
+
+
+def count(name, amount=1):
+    """ Add to a work counter """
+    if TRACER.active() or TRACER.collecting:
+        with TRACER.lock:
+            TRACER.counters[name] = TRACER.counters.get(name, 0) + amount
+
+
+def collect(func, *args):
+    """ Run func, returning its result and the work it counted
+
+    For worker processes, whose counters never reach the trace: the work is
+    counted whether or not tracing is on here, and handed back for merge.
+    """
+    with TRACER.lock:
+        saved, TRACER.counters = TRACER.counters, {}
+        TRACER.collecting = True
+    try:
+        result = func(*args)
+    finally:
+        with TRACER.lock:
+            counts, TRACER.counters = TRACER.counters, saved
+            TRACER.collecting = False
+    return result, counts
+
+
+def merge(counts):
+    """ Add work counted elsewhere, such as by collect in a worker process """
+    for name, amount in counts.items():
+        count(name, amount)
+
+
+@contextlib.contextmanager
+def span(name, **args):
+    """ Time a stage, noting the work counted while it ran; also usable as a decorator """
+    if not TRACER.active():
+        yield
+        return
+
+    with TRACER.lock:
+        before = dict(TRACER.counters)
+    start = TRACER.stamp()
+    wall = time.perf_counter()
+    cpu = cpu_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall
+        cpu = cpu_time() - cpu
+        rss, child_rss = peak_rss()
+        with TRACER.lock:
+            work = {
+                key: value - before.get(key, 0)
+                for key, value in TRACER.counters.items()
+                if value != before.get(key, 0)
+            }
+            TRACER.events.append(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": start,
+                    "dur": wall * 1e6,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": {**args, **work, "cpu_s": cpu, "peak_rss": rss},
+                }
+            )
+            TRACER.events.append(
+                {
+                    "name": "memory",
+                    "ph": "C",
+                    "ts": start + wall * 1e6,
+                    "pid": os.getpid(),
+                    "args": {"peak_rss": rss, "peak_child_rss": child_rss},
+                }
+            )
+            stage = TRACER.stages.setdefault(name, {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0})
+            stage["calls"] += 1
+            stage["wall_s"] += wall
+            stage["cpu_s"] += cpu
+        if TRACER.quiet and (work or wall >= 0.05):
+            done = ", ".join(f"{value} {key}" for key, value in work.items())
+            print(f"[{name}] {wall:.2f}s wall, {cpu:.2f}s cpu" + (f", {done}" if done else ""))
+
+
+def item(kind, line):
+    """ One item of per-item work, counted, and its line printed unless quiet """
+    items(kind, (line,), 1)
+
+
+def items(kind, lines, amount):
+    """ Many items of per-item work at once; lines is only iterated when printing """
+    count(kind, amount)
+    if not TRACER.quiet:
+        for line in lines:
+            print(line)
+        return
+
+    with TRACER.lock:
+        if kind not in TRACER.kinds:
+            TRACER.kinds.append(kind)
+        now = time.monotonic()
+        if now - TRACER.tallied < SUMMARY_EVERY:
+            return
+        TRACER.tallied = now
+        tally = ", ".join(f"{TRACER.counters.get(key, 0)} {key}" for key in TRACER.kinds)
+    print(f"... {tally}")
+
+
+def finish():
+    """ Write the trace out, with a summary of the stages, counters and peak memory """
+    rss, child_rss = peak_rss()
+    with TRACER.lock:
+        TRACER.events.append(
+            {
+                "name": "counters",
+                "ph": "C",
+                "ts": TRACER.stamp(),
+                "pid": os.getpid(),
+                "args": dict(TRACER.counters),
+            }
+        )
+        trace = {
+            "traceEvents": TRACER.events,
+            "displayTimeUnit": "ms",
+            "otherData": {
+                "command": " ".join(sys.argv),
+                "stages": TRACER.stages,
+                "counters": TRACER.counters,
+                "peak_rss": rss,
+                "peak_child_rss": child_rss,
+            },
+        }
+    with open(f"{TRACER.path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(trace, f)
+    os.replace(f"{TRACER.path}.tmp", TRACER.path)
+    print(f"Trace of {len(TRACER.stages)} stages written to {TRACER.path}")
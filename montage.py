@@ -1,11 +1,8 @@
 """ Draw an Image Montage """
 
-import hashlib
 import os.path
-
-from pathlib import Path
-
-import pickledb
+import threading
+import time
 
 from PyQt6.QtWidgets import (  # pylint: disable=no-name-in-module
     QApplication,
@@ -27,96 +24,144 @@ from wand.image import Image
 
 import yaml
 
-from lib.montage import is_image, makethumb
+from lib.atlas import TileAtlas
+from lib.build import find_locations, goal_layout, write_montage
+from lib.ingest import crawl_sources, ingest
+from lib.montage import calculate_big_pixels
+from lib.render import tile_source
+from lib.store import PaletteStore
+
+
+class Cancelled(Exception):
+    """The user asked for the running stage to stop"""
+
+
+class Throttle:
+    """Coalesce progress updates, passing on the latest of each at most every interval"""
+
+    def __init__(self, emit, interval=0.1):
+        self.emit = emit
+        self.interval = interval
+        self.latest = {}
+        self.sent = 0.0
+
+    def update(self, stage, value):
+        """Note a stage's progress, sending the batch if enough time has passed"""
+        self.latest[stage] = value
+        if time.monotonic() - self.sent >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Send whatever updates are waiting"""
+        if self.latest:
+            self.emit(self.latest)
+            self.latest = {}
+        self.sent = time.monotonic()
 
 
 class Worker(QObject):
-    """Background worker for image processing"""
+    """Background worker for image processing
 
-    finished = pyqtSignal()
-    progress = pyqtSignal(str)
+    Progress goes out as a dict of {stage: (done, total)}, at most ten times
+    a second, and setting the cancel event stops the running task at its
+    next update.
+    """
 
-    def __init__(self, config):
+    finished = pyqtSignal(str)
+    failed = pyqtSignal()
+    progress = pyqtSignal(dict)
+
+    def __init__(self, config, cancel):
         super().__init__()
         self.config = config
+        self.cancel = cancel
+        self.throttle = Throttle(self.progress.emit)
 
-    def scan_for_files(self):
-        """Long-running task."""
-        for path in Path(self.config["imagedir"]).rglob("*"):
-            if not path.is_file():
-                continue
-            if not is_image(path.name):
-                continue
-            self.progress.emit(str(path))
-        self.finished.emit()
-
-    def make_thumbnails(self):
-        """Long-running task."""
-        for file in self.config["files"]:
-            path = Path(file)
-            md5 = hashlib.md5(str(path).encode()).hexdigest()
-            outfile = os.path.join(
-                self.config["thumbdir"], f"{md5}.{self.config['thumbnail_type']}"
-            )
-            outfile_vid = os.path.join(
-                self.config["thumbdir"], f"{md5}-0.{self.config['thumbnail_type']}"
+    def report(self, stage, done, total=0):
+        """Pass on progress, or stop if the task has been cancelled"""
+        if self.cancel.is_set():
+            raise Cancelled()
+        self.throttle.update(stage, (done, total))
+
+    def run(self, task):
+        """Run a task, always ending with finished, however it ends
+
+        An error is shown as the status and also signalled as failed, so
+        the window doesn't go on to the next stage.
+        """
+        try:
+            message = task()
+        except Cancelled:
+            message = "Cancelled."
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            self.failed.emit()
+            message = f"Error: {error}"
+        self.throttle.flush()
+        self.finished.emit(message)
+
+    def ingest(self):
+        """Long-running task: crawl, thumbnail and analyze, all at once
+
+        Thumbnails are made as the crawl finds sources, and their palette
+        rows are written as they land.
+        """
+
+        def task():
+            sources = crawl_sources(
+                self.config["imagedir"], self.config.get("frame_step", 0) > 0
             )
-            if not Path(outfile).is_file() and not Path(outfile_vid).is_file():
-                makethumb(
-                    path,
-                    outfile,
-                    self.config["height_ratio"],
-                    self.config["pref_width"],
-                    self.config["pref_height"],
-                )
-            self.progress.emit(md5)
-        self.finished.emit()
-
-    def make_color_db(self):
-        """Long-running task."""
-        cache = self.config["color_db"]
-
-        for path in Path(self.config["thumbdir"]).rglob("*.png"):
-            if not path.is_file():
-                continue
-
-            if cache.exists(str(path)):
-                self.progress.emit("cache hit.")
-                continue
-
-            count = 0
-            count_red = 0
-            count_green = 0
-            count_blue = 0
-
-            try:
-                with Image(filename=path) as img:
-                    maxima = img.maxima
-                    if maxima < 65535:
-                        print(f"NOPE (depth is {maxima}) on {path}")
-                        continue
-
-                    blob = img.make_blob(format="RGB")
-                    for cursor in range(0, img.width * img.height * 3, 3):
-                        count_red += blob[cursor]
-                        count_green += blob[cursor + 1]
-                        count_blue += blob[cursor + 2]
-                        count += 1
-
-                av_r = int(count_red / count)
-                av_g = int(count_green / count)
-                av_b = int(count_blue / count)
-
-                cache.set(str(path), [av_r, av_g, av_b])
-                self.progress.emit(
-                    f"{av_r:03.0f} {av_g:03.0f} {av_b:03.0f} ({maxima:03.0f}) : {path}"
+            palette = ingest(self.config, sources, self.config["height_ratio"], self.report)
+            return f"{len(palette)} items in the palette."
+
+        self.run(task)
+
+    def render(self):
+        """Long-running task: match and draw the montage"""
+        self.run(self.draw)
+
+    def draw(self):
+        """Match and draw the montage, removing a partly written output if stopped"""
+        cache = PaletteStore(self.config["palette"])
+        if len(cache) == 0:
+            raise ValueError(f"NO CACHE: {cache.path}")
+
+        output = self.config.get("output", "output.png")
+        try:
+            img = goal_layout(self.config, self.config["goal"])
+            with img["ref"]:
+                bigpixels = calculate_big_pixels(
+                    img, self.config["upscale"], self.config.get("signature_grid", 0)
                 )
-            except IndexError:
-                print(f"NOPE on {path}")
-
-        cache.dump()
-        print(f"{cache.totalkeys()} items in the cache")
-        self.finished.emit()
+                self.report("match", 0, 0)
+                locations = find_locations(self.config, cache, bigpixels)
+
+                total = sum(len(points) for points in locations.values())
+                placed = 0
+                cache_size = None
+                if self.config.get("stream"):
+                    cache_size = self.config.get("tile_cache", 1024)
+                tiles = tile_source(img, self.atlas(cache, img), cache_size)
+
+                def tile_for(file):
+                    nonlocal placed
+                    placed += 1
+                    self.report("render", placed, total)
+                    return tiles(file)
+
+                write_montage(self.config, cache, img, bigpixels, locations, output, 0, tile_for)
+        except Cancelled:
+            if os.path.exists(output):
+                os.remove(output)
+            raise
+        return f"Montage written to {output}."
+
+    def atlas(self, cache, img):
+        """The tile atlas, if the config asks for one"""
+        if not self.config.get("atlas"):
+            return None
+        return TileAtlas(cache, img["pixel_width"], img["pixel_height"]).load(
+            self.config.get("workers", 0)
+        )
 
 
 class Window(QWidget):  # pylint: disable=too-many-instance-attributes
@@ -125,9 +170,10 @@ class Window(QWidget):  # pylint: disable=too-many-instance-attributes
     def __init__(self):
         super().__init__()
 
-        self.files = []
         self.thread = None
         self.worker = None
+        self.cancel = threading.Event()
+        self.failed = False
 
         with open("config.yaml", encoding="utf-8") as f:
             self.config = yaml.safe_load(f)
@@ -152,7 +198,7 @@ class Window(QWidget):  # pylint: disable=too-many-instance-attributes
 
         self.macro_progress_label = QLabel("Select files above")
         self.macro_progress_bar = QProgressBar()
-        self.macro_progress_bar.setRange(0, 5)
+        self.macro_progress_bar.setRange(0, 3)
 
         self.progress_label = QLabel("")
         self.progress_bar = QProgressBar()
@@ -161,6 +207,10 @@ class Window(QWidget):  # pylint: disable=too-many-instance-attributes
         self.status_text = QLabel("")
         self.status_text.setAlignment(Qt.AlignmentFlag.AlignCenter)
 
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.clicked.connect(self.cancel.set)
+
         self.quit_button = QPushButton("Quit")
         self.quit_button.clicked.connect(self.quit)
 
@@ -176,7 +226,8 @@ class Window(QWidget):  # pylint: disable=too-many-instance-attributes
         layout.addWidget(self.progress_label, 4, 0)
         layout.addWidget(self.progress_bar, 4, 1)
         layout.addWidget(self.status_text, 5, 0, 1, 2)
-        layout.addWidget(self.quit_button, 6, 0, 1, 2)
+        layout.addWidget(self.cancel_button, 6, 0, 1, 2)
+        layout.addWidget(self.quit_button, 7, 0, 1, 2)
 
         self.setLayout(layout)
 
@@ -184,7 +235,7 @@ class Window(QWidget):  # pylint: disable=too-many-instance-attributes
         """Check if we have picked the directories and can start processing
 
         If we are good, calculate default sizes and write data into the config.
-        Then start the image scan.
+        Then start the ingest.
         """
         if (
             os.path.exists(self.imagedir_label.text())
@@ -192,168 +243,113 @@ class Window(QWidget):  # pylint: disable=too-many-instance-attributes
             and os.path.isfile(self.goal_label.text())
         ):
 
-            self.config["imgdir"] = self.imagedir_label.text()
+            self.config["imagedir"] = self.imagedir_label.text()
             self.config["thumbdir"] = self.cache_label.text()
             self.config["goal"] = self.goal_label.text()
+            self.config["palette"] = os.path.join(self.config["thumbdir"], "palette.db")
 
-            self.config["color_db_file"] = os.path.join(
-                self.config["thumbdir"], "palette.db"
-            )
-            self.config["color_db"] = pickledb.load(self.config["color_db_file"], False)
-
-            with Image(filename=self.config["goal"]) as img:
+            with Image() as img:
+                img.ping(filename=self.config["goal"])
                 self.config["height_ratio"] = img.height / img.width
-                self.config["pref_width"] = self.config["default_size"]
-                self.config["pref_height"] = int(
-                    self.config["default_size"] * self.config["height_ratio"]
-                )
 
-            self.scan_for_files()
+            self.start_ingest()
 
-    def scan_for_files(self):
-        """Crawl the file system to determine a list of files to examine"""
+    def run_worker(self, task, done):
+        """Run one of the worker's tasks on a fresh thread"""
+        self.cancel.clear()
+        self.failed = False
         self.thread = QThread()
-        self.worker = Worker(self.config)
+        self.worker = Worker(self.config, self.cancel)
         self.worker.moveToThread(self.thread)
-        self.thread.started.connect(self.worker.scan_for_files)
+        self.thread.started.connect(getattr(self.worker, task))
+        self.worker.progress.connect(self.show_progress)
+        self.worker.failed.connect(self.task_failed)
+        self.worker.finished.connect(self.status_text.setText)
         self.worker.finished.connect(self.thread.quit)
         self.worker.finished.connect(self.worker.deleteLater)
         self.thread.finished.connect(self.thread.deleteLater)
-        self.worker.progress.connect(self.scan_for_files_progress)
+        self.thread.finished.connect(self.thread_done)
+        self.thread.finished.connect(done)
         self.thread.start()
 
         self.imagedir.setEnabled(False)
         self.cache.setEnabled(False)
         self.goal.setEnabled(False)
+        self.cancel_button.setEnabled(True)
 
-        self.macro_progress_bar.setValue(1)
-        self.macro_progress_label.setText("Finding files... ")
-        self.progress_bar.setRange(0, 0)
-
-        self.thread.finished.connect(
-            lambda: self.scan_for_files_done()  # pylint: disable=unnecessary-lambda
-        )
-
-    def scan_for_files_progress(self, n):
-        """Update progress; stub for now"""
-        self.files.append(n)
-        self.status_text.setText(f"{n[-25:]:25}")
-
-    def scan_for_files_done(self):
-        """We've found all the files, start processing"""
-        self.progress_bar.setRange(0, len(self.files))
-        self.progress_label.setText(f"{len(self.files)} files found")
-        self.status_text.setText("")
-
-        self.cache_files()
-
-    def cache_files(self):
-        """Go through the file-list and create thumnails in the cache"""
-        self.config["files"] = self.files  # This can't be good
-
-        self.thread = QThread()
-        self.worker = Worker(self.config)
-        self.worker.moveToThread(self.thread)
-        self.thread.started.connect(self.worker.make_thumbnails)
-        self.worker.finished.connect(self.thread.quit)
-        self.worker.finished.connect(self.worker.deleteLater)
-        self.thread.finished.connect(self.thread.deleteLater)
-        self.worker.progress.connect(self.cache_files_progress)
-        self.thread.start()
+    def thread_done(self):
+        """Forget the finished thread"""
+        self.thread = None
+        self.worker = None
 
-        self.imagedir.setEnabled(False)
-        self.cache.setEnabled(False)
-        self.goal.setEnabled(False)
+    def task_failed(self):
+        """Note that the running task hit an error, so the run stops after it"""
+        self.failed = True
 
-        self.macro_progress_bar.setValue(2)
+    def start_ingest(self):
+        """Crawl, thumbnail and analyze the image directory as one pipelined task"""
+        self.macro_progress_bar.setValue(1)
         self.macro_progress_label.setText("Caching images... ")
-        self.progress_bar.setRange(0, len(self.files))
-
-        self.thread.finished.connect(
-            lambda: self.cache_files_done()  # pylint: disable=unnecessary-lambda
-        )
-
-    def cache_files_progress(self, md5val):
-        """Update progress; stub for now"""
-        self.status_text.setText(f"{md5val}")
-        newval = self.progress_bar.value() + 1
-        self.progress_label.setText(f"{newval} / {len(self.files)}")
-        self.progress_bar.setValue(newval)
-
-    def cache_files_done(self):
-        """We've found all the files, start processing"""
-        self.progress_label.setText(f"{len(self.files)} files cached.")
-        self.status_text.setText("")
-
-        self.color_db()
-
-    def color_db(self):
-        """Go through the file-list and create thumnails in the cache"""
-        self.config["files"] = self.files  # This can't be good
-
-        self.thread = QThread()
-        self.worker = Worker(self.config)
-        self.worker.moveToThread(self.thread)
-        self.thread.started.connect(self.worker.make_color_db)
-        self.worker.finished.connect(self.thread.quit)
-        self.worker.finished.connect(self.worker.deleteLater)
-        self.thread.finished.connect(self.thread.deleteLater)
-        self.worker.progress.connect(self.color_db_progress)
-        self.thread.start()
-
-        self.imagedir.setEnabled(False)
-        self.cache.setEnabled(False)
-        self.goal.setEnabled(False)
-
-        self.macro_progress_bar.setValue(3)
-        self.macro_progress_label.setText("Analyzing colors... ")
-        self.progress_bar.setRange(0, len(self.files))
-        self.progress_bar.setValue(0)
-
-        self.thread.finished.connect(
-            lambda: self.color_db_done()  # pylint: disable=unnecessary-lambda
-        )
-
-    def color_db_progress(self, _):
-        """Update progress; stub for now"""
-        newval = self.progress_bar.value() + 1
-        self.progress_label.setText(f"{newval} / {len(self.files)}")
-        self.progress_bar.setValue(newval)
-
-    def color_db_done(self):
-        """We've found all the files, start processing"""
-        self.status_text.setText(f"{len(self.files)} files analyzed.")
-
-        self.render_montage()
-
-    def render_montage(self):
-        """Draw the montage!"""
-        self.macro_progress_bar.setValue(4)
+        self.progress_bar.setRange(0, 0)
+        self.run_worker("ingest", self.ingest_done)
+
+    def show_progress(self, updates):
+        """Show a batch of {stage: (done, total)} progress updates"""
+        if "scan" in updates:
+            self.status_text.setText(f"{updates['scan'][0]} files found")
+        if "palette" in updates:
+            self.progress_label.setText(f"{updates['palette'][0]} in the palette")
+        for stage in ("thumb", "render"):
+            if stage in updates:
+                done, total = updates[stage]
+                self.progress_bar.setRange(0, max(total, 1))
+                self.progress_bar.setValue(done)
+                self.progress_label.setText(f"{done} / {total}")
+        if "match" in updates:
+            self.progress_bar.setRange(0, 0)
+            self.progress_label.setText("Matching tiles...")
+
+    def ingest_done(self):
+        """The palette is up to date, render unless we were cancelled or it failed"""
+        if self.cancel.is_set() or self.failed:
+            self.stopped()
+            return
+        self.start_render()
+
+    def start_render(self):
+        """Match and draw the montage off the UI thread"""
+        self.macro_progress_bar.setValue(2)
         self.macro_progress_label.setText("Rendering montage... ")
-        self.progress_bar.setRange(0, len(self.files))
-        self.progress_bar.setValue(0)
-
+        self.progress_bar.setRange(0, 0)
         self.progress_label.setText("")
-        self.status_text.setText("")
+        self.run_worker("render", self.render_done)
 
-        #self.thread.finished.connect(
-        #    lambda: self.render_montage_done()  # pylint: disable=unnecessary-lambda
-        #)
+    def render_done(self):
+        """All done."""
+        if self.cancel.is_set() or self.failed:
+            self.stopped()
+            return
+        self.macro_progress_bar.setValue(3)
+        self.macro_progress_label.setText("")
+        self.progress_bar.setRange(0, 1)
+        self.progress_bar.setValue(0)
+        self.stopped()
 
-        self.render_montage_done()
+    def stopped(self):
+        """Let a new run be set up"""
+        self.cancel_button.setEnabled(False)
+        self.imagedir.setEnabled(True)
+        self.cache.setEnabled(True)
+        self.goal.setEnabled(True)
 
     def quit(self):
         """Quit the App"""
+        self.cancel.set()
+        if self.thread is not None:
+            self.thread.quit()
+            self.thread.wait()
         self.close()
 
-    def render_montage_done(self):
-        """All done."""
-
-        self.macro_progress_bar.setValue(5)
-        self.macro_progress_label.setText("")
-        self.status_text.setText("Montage completed.")
-        self.progress_bar.setValue(0)
-
     @pyqtSlot()
     def get_dir(self, label):
         """Dialog to select a directory"""
@@ -376,7 +372,18 @@ class Window(QWidget):  # pylint: disable=too-many-instance-attributes
         self.check_status()
 
 
-app = QApplication([])
-window = Window()
-window.show()
-app.exec()
+def main():
+    """Start the app
+
+    Kept out of import time: worker pools that spawn rather than fork (macOS,
+    Windows) re-import this module in every worker, which must not open a
+    window of its own.
+    """
+    app = QApplication([])
+    window = Window()
+    window.show()
+    app.exec()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,53 +1,73 @@
 #!/usr/bin/env python3
-"""Building a palette database of the provided directory of images."""
+"""Building a palette database of the provided directory of images.
 
+Run over a thumbnail directory made by the pipeline, the near-duplicates its
+manifest says were left out of the palette stay out.
+"""
+
+import os
 import sys
 
 from pathlib import Path
 
-import pickledb
+import yaml
+
+from lib.manifest import ThumbManifest
+from lib.montage import is_image
+from lib.palette import analyze_images
+from lib.store import CHANNELS, PaletteStore
+from lib import trace
 
-from wand.image import Image
+
+def without_duplicates(imagedir, paths):
+    """ The paths but for thumbnails the pipeline's manifest left out of the palette """
+    duplicates = {os.path.abspath(thumb) for thumb in ThumbManifest(imagedir, {}).duplicates()}
+    kept = [path for path in paths if os.path.abspath(path) not in duplicates]
+    trace.count("near-duplicates skipped", len(paths) - len(kept))
+    return kept
 
 
 def main():  # pylint: disable=missing-function-docstring
-    cache = pickledb.load(sys.argv[1], False)
+    with open("config.yaml", encoding="utf-8") as f:
+        config = yaml.safe_load(f)
+    trace.setup(config)
+
+    cache = PaletteStore(sys.argv[1])
     imagedir = sys.argv[2]
 
-    for path in Path(imagedir).rglob("*"):
-        if not path.is_file():
-            continue
-
-        count = 0
-        count_red = 0
-        count_green = 0
-        count_blue = 0
-
-        try:
-            with Image(filename=path) as img:
-                maxima = img.maxima
-                if maxima < 65535:
-                    print(f"NOPE (depth is {maxima}) on {path}")
-                    continue
-
-                blob = img.make_blob(format="RGB")
-                for cursor in range(0, img.width * img.height * 3, 3):
-                    count_red += blob[cursor]
-                    count_green += blob[cursor + 1]
-                    count_blue += blob[cursor + 2]
-                    count += 1
-
-            av_r = int(count_red / count)
-            av_g = int(count_green / count)
-            av_b = int(count_blue / count)
-
-            print(f"{av_r:03.0f} {av_g:03.0f} {av_b:03.0f} ({maxima:03.0f}) : {path}")
-            cache.set(str(path), [av_r, av_g, av_b])
-        except IndexError:
-            print(f"NOPE on {path}")
-
-    cache.dump()
-    print(f"{cache.totalkeys()} items in the cache")
+    grid = config.get("signature_grid", 0)
+    if len(cache) and cache.grid != grid:
+        print(f"Signature grid changed from {cache.grid} to {grid}, rebuilding the palette")
+        cache.write([], [], CHANNELS * (1 + grid * grid))
+
+    with trace.span("crawl"):
+        found = [
+            path for path in Path(imagedir).rglob("*") if path.is_file() and is_image(path.name)
+        ]
+        paths = [path for path in found if path not in cache]
+        trace.count("cache hits", len(found) - len(paths))
+        paths = without_duplicates(imagedir, paths)
+    entries = []
+
+    with trace.span("analyze"):
+        for path, color, maxima in analyze_images(paths, config.get("workers", 0), grid):
+            trace.count("images decoded")
+            if color is None:
+                if maxima is None:
+                    trace.item("rejected", f"NOPE on {path}")
+                else:
+                    trace.item("rejected", f"NOPE (depth is {maxima}) on {path}")
+                continue
+
+            av_r, av_g, av_b = color[:3]
+            trace.item(
+                "analyzed", f"{av_r:03.0f} {av_g:03.0f} {av_b:03.0f} ({maxima:03.0f}) : {path}"
+            )
+            entries.append((path, color))
+
+    with trace.span("write"):
+        cache.append(entries)
+    print(f"{len(cache)} items in the cache")
 
 
 if __name__ == "__main__":
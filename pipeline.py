@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""Run the whole montage build as one pipeline, only redoing stages whose inputs changed."""
+
+import argparse
+import os
+import sys
+
+from pathlib import Path
+
+import yaml
+
+from wand.image import Image
+
+from lib.build import (
+    INDEX_KEYS,
+    find_locations,
+    goal_layout,
+    match_indexes,
+    parse_build_args,
+    write_montage,
+    write_pixelated,
+)
+from lib.ingest import ingest, scan_sources
+from lib.manifest import content_hash
+from lib.montage import calculate_big_pixels
+from lib.pipeline import Pipeline
+from lib.store import PaletteStore
+
+THUMB_KEYS = (
+    "thumbdir",
+    "palette",
+    "default_size",
+    "thumbnail_type",
+    "signature_grid",
+    "dedupe_distance",
+    "frame_step",
+    "frame_scene",
+    "frame_dedupe",
+)
+ANALYZE_KEYS = ("upscale", "default_size", "signature_grid")
+MATCH_KEYS = INDEX_KEYS + ("color_distance", "max_uses", "min_spacing", "seed")
+RENDER_KEYS = (
+    "output",
+    "draft",
+    "stream",
+    "tint_mode",
+    "tint_strength",
+    "pyramid_tile_size",
+    "pyramid_format",
+)
+
+
+def palette_current(result):
+    """ Check the palette a cached stage made is still the one on disk """
+    return (
+        os.path.exists(result["palette"])
+        and PaletteStore(result["palette"]).version == result["version"]
+    )
+
+
+def file_stamp(path):
+    """ The size and modification time of a file """
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def files_current(result):
+    """ Check the files a cached stage wrote haven't been touched since """
+    for file, (size, mtime) in result["files"].items():
+        if not os.path.exists(file) or file_stamp(file) != (size, mtime):
+            return False
+    return True
+
+
+def build_pipeline(config):  # pylint: disable=too-many-locals
+    """ The scan -> thumb -> palette -> analyze -> match -> render pipeline for a config """
+    pipe = Pipeline(config, config.get("pipeline_cache", "data/pipeline"))
+
+    @pipe.stage("scan", volatile=True)
+    def scan(config):
+        if not os.path.isdir(config["imagedir"]):
+            sys.exit(f"ERROR: Image directory {config['imagedir']} dosen't exist")
+        sources = scan_sources(config["imagedir"], config.get("frame_step", 0) > 0)
+        return [(str(path), *file_stamp(path)) for path in sources]
+
+    @pipe.stage("goal", volatile=True)
+    def goal(config):
+        with Image() as probe:
+            probe.ping(filename=config["goal"])
+            size = (probe.width, probe.height)
+        return {"path": config["goal"], "hash": content_hash(config["goal"]), "size": size}
+
+    @pipe.stage("thumb", inputs=("scan", "goal"), keys=THUMB_KEYS, fresh=palette_current)
+    def thumb(config, sources, goal):
+        os.makedirs(config["thumbdir"], exist_ok=True)
+        width, height = goal["size"]
+        palette = ingest(config, [Path(source[0]) for source in sources], height / width)
+        return {"palette": palette.path, "version": palette.version}
+
+    @pipe.stage("palette", inputs=("thumb",), keys=INDEX_KEYS, fresh=palette_current)
+    def palette(config, thumbs):
+        cache = PaletteStore(thumbs["palette"])
+        if len(cache) == 0:
+            sys.exit(f"NO CACHE: {cache.path}")
+        print(f"We have {len(cache)} potential pixel images")
+        match_indexes(config, cache)
+        return thumbs
+
+    @pipe.stage("analyze", inputs=("goal",), keys=ANALYZE_KEYS)
+    def analyze(config, goal):
+        img = goal_layout(config, goal["path"])
+        bigpixels = calculate_big_pixels(
+            img, config["upscale"], config.get("signature_grid", 0)
+        )
+        img.pop("ref").close()
+        return {"img": img, "bigpixels": bigpixels}
+
+    @pipe.stage("match", inputs=("palette", "analyze"), keys=MATCH_KEYS)
+    def match(config, palette, analyzed):
+        return find_locations(config, PaletteStore(palette["palette"]), analyzed["bigpixels"])
+
+    @pipe.stage(
+        "render", inputs=("goal", "palette", "analyze", "match"), keys=RENDER_KEYS,
+        fresh=files_current,
+    )
+    def render(config, goal, palette, analyzed, locations):  # pylint: disable=R0913
+        img = dict(analyzed["img"], ref=Image(filename=goal["path"]))
+        draft = config.get("draft", 0)
+        with img["ref"]:
+            files = [
+                write_pixelated(config, img, analyzed["bigpixels"], draft),
+                write_montage(
+                    config,
+                    PaletteStore(palette["palette"]),
+                    img,
+                    analyzed["bigpixels"],
+                    locations,
+                    config["output"],
+                    draft,
+                ),
+            ]
+        return {"files": {file: file_stamp(file) for file in files}}
+
+    return pipe
+
+
+def main():  # pylint: disable=missing-function-docstring
+    with open("config.yaml", encoding="utf-8") as f:
+        config = yaml.safe_load(f)
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("goal", nargs="?", default=config["goal"], help="the image to build")
+    parser.add_argument(
+        "output",
+        nargs="?",
+        default="output.png",
+        help="where to write it (.dzi for a Deep Zoom pyramid)",
+    )
+    parser.add_argument(
+        "--stage", default="render", help="the stage to run up to (default: render)"
+    )
+    args = parse_build_args(parser, config)
+
+    config.update(goal=args.goal, output=args.output, draft=args.draft)
+    build_pipeline(config).run(args.stage)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,20 @@
 #!/usr/bin/env python3
-""" Crawl a given directory of images, and cache smaller versions for analysis """
+""" Crawl a given directory of images, cache smaller versions and add them to the palette """
 
-import hashlib
 import os
 
-from pathlib import Path
-
 import yaml
 
 from wand.image import Image
 
-from lib.montage import is_image, makethumb
+from lib.ingest import ingest, scan_sources
+from lib import trace
 
 
 def main():  # pylint: disable=missing-function-docstring
     with open("config.yaml", encoding="utf-8") as f:
         config = yaml.safe_load(f)
+    trace.setup(config)
 
     assert os.path.exists(
         config["imagedir"]
@@ -41,33 +40,10 @@ def main():  # pylint: disable=missing-function-docstring
     with Image(filename=config["goal"]) as img:
         height_ratio = img.height / img.width
         print(f"Height ratio is {height_ratio}")
-        pref_width = config["default_size"]
-        pref_height = int(config["default_size"] * height_ratio)
-
-    print(
-        "/-----------------------------------------------------------------------------\\"
-    )
-    print(
-        "|         Filename         | Start Size | End Size |          Status          |"
-    )
-    print(
-        "|--------------------------|------------|----------|--------------------------|"
-    )
-
-    for path in Path(config["imagedir"]).rglob("*"):
-        if not path.is_file():
-            continue
-        if not is_image(path.name):
-            continue
-
-        md5 = hashlib.md5(str(path).encode()).hexdigest()
-        outfile = os.path.join(config["thumbdir"], f"{md5}.{config['thumbnail_type']}")
-
-        makethumb(path, outfile, height_ratio, pref_width, pref_height)
 
-    print(
-        "\\-----------------------------------------------------------------------------/\n"
-    )
+    with trace.span("crawl"):
+        sources = scan_sources(config["imagedir"], config.get("frame_step", 0) > 0)
+    ingest(config, sources, height_ratio)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""Render montages from a warm palette: as a local HTTP service, or for a directory of goals."""
+
+import argparse
+import os
+import sys
+import time
+
+from pathlib import Path
+
+import yaml
+
+from lib.montage import is_image
+from lib.server import RenderService, serve
+
+
+def main():  # pylint: disable=missing-function-docstring
+    with open("config.yaml", encoding="utf-8") as f:
+        config = yaml.safe_load(f)
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=config.get("server_jobs", 2),
+        help="how many montages to render at once",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serving = commands.add_parser("serve", help="accept jobs over HTTP")
+    serving.add_argument("--host", default="127.0.0.1")
+    serving.add_argument("--port", type=int, default=config.get("server_port", 8765))
+
+    batch = commands.add_parser("batch", help="render every image in a directory")
+    batch.add_argument("goals", help="directory of goal images")
+    batch.add_argument("outdir", help="directory to write the montages to")
+    batch.add_argument("--draft", nargs="?", type=int, const=8, default=0, metavar="SCALE")
+
+    args = parser.parse_args()
+    service = RenderService(config, args.jobs)
+
+    if args.command == "serve":
+        serve(service, args.host, args.port)
+        return
+
+    os.makedirs(args.outdir, exist_ok=True)
+    goals = sorted(path for path in Path(args.goals).iterdir() if is_image(path.name))
+    start = time.time()
+    for goal in goals:
+        service.submit(str(goal), os.path.join(args.outdir, f"{goal.stem}.png"), args.draft)
+
+    failed = 0
+    for job in service.wait():
+        if job["status"] == "done":
+            print(f"{job['goal']} -> {job['output']} ({job['finished'] - job['started']:.1f}s)")
+        else:
+            failed += 1
+            print(f"FAILED {job['goal']} : {job.get('error')}")
+    service.pool.shutdown()
+
+    print(f"{len(goals) - failed} of {len(goals)} montages in {time.time() - start:.1f}s")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()